@@ -3,19 +3,31 @@ MagnaTagATune Dataset Setup and Filtering for Amapiano Proxy Training
 Downloads and filters the MagnaTagATune dataset to create an Amapiano-relevant subset
 """
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import urllib.request
 import zipfile
 from pathlib import Path
 import logging
-from typing import Set, List, Dict
+from typing import Set, List, Dict, Optional, Tuple, Union
 import shutil
 import json
+import pickle
 import hashlib
 from tqdm import tqdm
 import time
-import subprocess
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+try:
+    from stream_unzip import stream_unzip
+    STREAM_UNZIP_AVAILABLE = True
+except ImportError:
+    STREAM_UNZIP_AVAILABLE = False
 
 logging.basicConfig(
     level=logging.INFO,
@@ -28,6 +40,7 @@ ANNOTATIONS_URL = "https://mirg.city.ac.uk/datasets/magnatagatune/annotations_fi
 DATASET_DIR = Path("./datasets/magnatagatune")
 OUTPUT_DIR = Path("./datasets/amapiano_proxy")
 CHECKPOINT_FILE = DATASET_DIR / "download_checkpoint.json"
+MP3_INDEX_CACHE = DATASET_DIR / "mp3_index.pkl"
 
 AMAPIANO_PROXY_TAGS = {
     'drums', 'percussion', 'beats', 'techno', 'electronic',
@@ -38,8 +51,24 @@ AMAPIANO_PROXY_TAGS = {
     'instrumental', 'ambient'
 }
 
+AMAPIANO_PROXY_TAGS_LOWER = frozenset(tag.lower() for tag in AMAPIANO_PROXY_TAGS)
+
+# Extract while downloading instead of saving the 2.9GB zip first (needs stream-unzip)
+STREAM_EXTRACT = os.environ.get("AMAPIANO_STREAM_EXTRACT", "0") == "1"
+
 MIN_TAGS_MATCH = 3
 TARGET_CLIPS = 8000
+COPY_BUFSIZE = 1 << 20  # 1MB, vs shutil's 64KB default
+PROGRESS_BATCH = 128
+
+# Narrow dtypes: proxy score is at most len(AMAPIANO_PROXY_TAGS), clip ids fit int32
+METADATA_SCHEMA = pa.schema([
+    ('clip_id', pa.int32()),
+    ('file_path', pa.string()),
+    ('amapiano_proxy_score', pa.int8()),
+    ('tags', pa.large_list(pa.string())),
+    ('duration', pa.float32()),
+])
 
 
 def download_with_progress(url: str, dest_path: Path, desc: str):
@@ -62,20 +91,268 @@ def download_with_progress(url: str, dest_path: Path, desc: str):
     logger.info(f"Downloaded: {dest_path}")
 
 
+def _fetch_range(url: str, fd: int, start: int, end: int, progress_bar: tqdm):
+    """Fetch bytes [start, end] of url and write them at their absolute offset"""
+    request = urllib.request.Request(url, headers={'Range': f'bytes={start}-{end}'})
+    with urllib.request.urlopen(request) as response:
+        if response.status != 206:
+            raise IOError(f"Server ignored range request (HTTP {response.status})")
+        offset = start
+        while buffer := response.read(COPY_BUFSIZE):
+            os.pwrite(fd, buffer, offset)
+            offset += len(buffer)
+            progress_bar.update(len(buffer))
+    if offset != end + 1:
+        raise IOError(f"Short read for bytes {start}-{end}: got {offset - start}")
+
+
+def download_parallel_ranges(url: str, dest_path: Path, desc: str, num_connections: int = 8):
+    """Download file over several concurrent HTTP range requests
+    
+    A single stream is capped by TCP slow-start and per-connection CDN rate
+    limits; N ranges written in place with pwrite() sidestep both.
+    """
+    # A 1-byte range probe resolves redirects and reports the total size
+    probe = urllib.request.Request(url, headers={'Range': 'bytes=0-0'})
+    with urllib.request.urlopen(probe) as response:
+        content_range = response.headers.get('Content-Range', '')
+        if response.status != 206 or '/' not in content_range:
+            raise IOError("Server does not support range requests")
+        total_size = int(content_range.rsplit('/', 1)[1])
+        url = response.geturl()
+    
+    chunk = -(-total_size // num_connections)
+    ranges = [(start, min(start + chunk, total_size) - 1) for start in range(0, total_size, chunk)]
+    
+    progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, desc=desc)
+    try:
+        fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, total_size)
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [
+                    executor.submit(_fetch_range, url, fd, start, end, progress_bar)
+                    for start, end in ranges
+                ]
+                for future in as_completed(futures):
+                    future.result()
+        finally:
+            os.close(fd)
+    except BaseException:
+        # Never leave a sparse, partially written archive behind
+        dest_path.unlink(missing_ok=True)
+        raise
+    finally:
+        progress_bar.close()
+    
+    logger.info(f"Downloaded: {dest_path} ({len(ranges)} parallel connections)")
+
+
 def verify_file_checksum(file_path: Path, expected_md5: str = None) -> bool:
     """Verify file integrity via MD5 checksum"""
     if not expected_md5:
         return True
     
-    md5_hash = hashlib.md5()
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5_hash.update(chunk)
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            md5_hash = hashlib.file_digest(f, 'md5')
+        else:
+            md5_hash = hashlib.md5()
+            buf = bytearray(COPY_BUFSIZE)
+            view = memoryview(buf)
+            while n := f.readinto(buf):
+                md5_hash.update(view[:n])
     
     actual_md5 = md5_hash.hexdigest()
     return actual_md5 == expected_md5
 
 
+def _matched_cols(columns) -> List[str]:
+    """Annotation columns that are Amapiano proxy tags (case-insensitive)"""
+    return [col for col in columns if col.lower() in AMAPIANO_PROXY_TAGS_LOWER]
+
+
+def _copy_file_range(src_fd: int, dst_fd: int):
+    """In-kernel copy (reflink on btrfs/xfs, server-side copy on NFS)"""
+    while os.copy_file_range(src_fd, dst_fd, 1 << 30):
+        pass
+
+
+def _sendfile(src_fd: int, dst_fd: int):
+    """Zero-copy kernel path for filesystems without copy_file_range"""
+    offset = 0
+    while sent := os.sendfile(dst_fd, src_fd, offset, 1 << 30):
+        offset += sent
+
+
+def _fastcopy(src: Union[str, Path], dst: Union[str, Path]):
+    """Copy file contents only (no copystat), preferring zero-copy kernel paths"""
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for kernel_copy, available in (
+                (_copy_file_range, hasattr(os, 'copy_file_range')),
+                (_sendfile, hasattr(os, 'sendfile')),
+            ):
+                if not available:
+                    continue
+                try:
+                    kernel_copy(src_fd, dst_fd)
+                    return
+                except OSError:
+                    # Unsupported on this filesystem - rewind and try the next strategy
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dst_fd, 0)
+            
+            with open(src_fd, 'rb', buffering=0, closefd=False) as fsrc, \
+                    open(dst_fd, 'wb', closefd=False) as fdst:
+                buf = bytearray(COPY_BUFSIZE)
+                view = memoryview(buf)
+                while n := fsrc.readinto(buf):
+                    fdst.write(view[:n])
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _copy_if_changed(src: Union[str, Path], dst: Union[str, Path]) -> bool:
+    """_fastcopy unless dst already exists with the same size; True if copied"""
+    try:
+        if os.stat(dst).st_size == os.stat(src).st_size:
+            return False
+    except FileNotFoundError:
+        pass
+    _fastcopy(src, dst)
+    return True
+
+
+def _index_mp3s(root: Path) -> Dict[str, str]:
+    """Map MP3 file names to paths with an iterative os.scandir walk
+    
+    DirEntry caches d_type from readdir, so no per-file stat() calls and no
+    Path objects are created for the ~25k entries.
+    """
+    index = {}
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.mp3'):
+                    index.setdefault(entry.name, entry.path)
+    return index
+
+
+def _extract_members(zip_path: Path, targets: List[Tuple[str, str]]) -> Tuple[List[str], int]:
+    """Extract (member, destination) pairs through a private ZipFile handle
+    
+    Returns the members now on disk (unsafe ones are refused and left out)
+    and how many of them were already extracted in full and left as-is.
+    """
+    done = []
+    up_to_date = 0
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member, dest in targets:
+            # extractall() sanitizes member names; keep refusing path traversal here
+            if Path(member).is_absolute() or '..' in Path(member).parts:
+                logger.warning(f"Skipping unsafe archive member: {member}")
+                continue
+            # Resumed runs skip members already extracted in full
+            try:
+                if os.stat(dest).st_size == zip_ref.getinfo(member).file_size:
+                    up_to_date += 1
+                    done.append(member)
+                    continue
+            except FileNotFoundError:
+                pass
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with zip_ref.open(member) as src, open(dest, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            done.append(member)
+    return done, up_to_date
+
+
+def _parallel_extract(zip_path: Path, targets: List[Tuple[str, str]]) -> Tuple[Set[str], int]:
+    """Decompress zip members across processes
+    
+    Members are compressed independently, so each worker opens its own
+    handle and inflates an interleaved share of the targets. Returns the
+    members now on disk and how many were already extracted in full.
+    """
+    num_workers = max(1, min(os.cpu_count() or 1, len(targets)))
+    partitions = [targets[i::num_workers] for i in range(num_workers)]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_extract_members, zip_path, part) for part in partitions]
+        done, up_to_date = set(), 0
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting"):
+            members, skipped = future.result()
+            done.update(members)
+            up_to_date += skipped
+    return done, up_to_date
+
+
+def _dir_signature(root: Path) -> Tuple:
+    """mtimes of root and its immediate subdirectories (the zip's 0/..f/ shards)"""
+    with os.scandir(root) as it:
+        subdirs = sorted(
+            (entry.name, entry.stat(follow_symlinks=False).st_mtime_ns)
+            for entry in it if entry.is_dir(follow_symlinks=False)
+        )
+    return (str(root), os.stat(root).st_mtime_ns, tuple(subdirs))
+
+
+def load_mp3_index(root: Path) -> Dict[str, str]:
+    """_index_mp3s memoized on disk, so resumed runs skip the directory walk"""
+    signature = _dir_signature(root)
+    
+    if MP3_INDEX_CACHE.exists():
+        try:
+            cached = pickle.loads(MP3_INDEX_CACHE.read_bytes())
+            if cached['signature'] == signature:
+                logger.info(f"Loaded cached MP3 index from {MP3_INDEX_CACHE}")
+                return cached['index']
+        except (pickle.UnpicklingError, EOFError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable MP3 index cache: {e}")
+    
+    index = _index_mp3s(root)
+    MP3_INDEX_CACHE.write_bytes(pickle.dumps({'signature': signature, 'index': index}))
+    return index
+
+
+def stream_extract_from_url(url: str, targets: Dict[str, str]) -> Set[str]:
+    """Extract archive members while the HTTP response is still arriving
+    
+    targets maps member file names to destination paths; every other member
+    is drained and discarded. No intermediate zip is written. Returns the
+    names that were extracted.
+    """
+    def http_chunks():
+        with urllib.request.urlopen(url) as response:
+            while chunk := response.read(COPY_BUFSIZE):
+                yield chunk
+    
+    extracted = set()
+    for name, _size, chunks in tqdm(stream_unzip(http_chunks()), desc="Streaming archive", unit=" files"):
+        member_name = Path(name.decode('utf-8')).name
+        dest = targets.get(member_name)
+        if dest is None:
+            for _ in chunks:  # stream_unzip requires each member to be consumed
+                pass
+            continue
+        
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        extracted.add(member_name)
+    
+    return extracted
+
+
 def save_checkpoint(stage: str, data: Dict):
     """Save checkpoint for resume capability"""
     checkpoint = {
@@ -98,13 +375,10 @@ def load_checkpoint() -> Dict:
     return None
 
 
-def download_dataset():
-    """Download MagnaTagATune dataset with checkpointing"""
+def download_annotations() -> Path:
+    """Download MagnaTagATune annotations with checkpointing"""
     DATASET_DIR.mkdir(parents=True, exist_ok=True)
     
-    checkpoint = load_checkpoint()
-    
-    # Download annotations
     logger.info("Downloading MagnaTagATune annotations...")
     annotations_path = DATASET_DIR / "annotations_final.csv"
     
@@ -118,37 +392,57 @@ def download_dataset():
     else:
         logger.info("Annotations already downloaded")
     
+    return annotations_path
+
+
+def download_mp3_archive() -> Path:
+    """Download the MagnaTagATune MP3 archive from HuggingFace"""
+    DATASET_DIR.mkdir(parents=True, exist_ok=True)
+    zip_path = DATASET_DIR / "mp3.zip"
+    
+    if zip_path.exists():
+        logger.info(f"MP3 archive already downloaded: {zip_path}")
+        return zip_path
+    
+    logger.info("Downloading MagnaTagATune MP3 files from HuggingFace...")
+    logger.info("This is a ~2.9GB download, please be patient...")
+    
+    try:
+        download_parallel_ranges(
+            MAGNATAGATUNE_ZIP_URL,
+            zip_path,
+            "MP3 Archive"
+        )
+    except (IOError, ValueError) as e:
+        logger.warning(f"Parallel download failed ({e}), falling back to a single stream...")
+        download_with_progress(
+            MAGNATAGATUNE_ZIP_URL,
+            zip_path,
+            "MP3 Archive"
+        )
+    
+    return zip_path
+
+
+def download_dataset():
+    """Download MagnaTagATune dataset and extract every MP3, with checkpointing"""
+    checkpoint = load_checkpoint()
+    
+    annotations_path = download_annotations()
+    
     # Download and extract MP3 files from HuggingFace
     mp3_dir = DATASET_DIR / "mp3"
-    zip_path = DATASET_DIR / "mp3.zip"
     
     if not mp3_dir.exists() or not any(mp3_dir.glob("*.mp3")):
-        logger.info("Downloading MagnaTagATune MP3 files from HuggingFace...")
-        logger.info("This is a ~2.9GB download, please be patient...")
-        
-        if not zip_path.exists():
-            try:
-                # Use wget for better progress display
-                subprocess.run([
-                    "wget",
-                    MAGNATAGATUNE_ZIP_URL,
-                    "-O", str(zip_path)
-                ], check=True)
-                logger.info(f"Download complete: {zip_path}")
-            except subprocess.CalledProcessError:
-                logger.warning("wget failed, trying urllib...")
-                download_with_progress(
-                    MAGNATAGATUNE_ZIP_URL,
-                    zip_path,
-                    "MP3 Archive"
-                )
+        zip_path = download_mp3_archive()
         
         # Extract
         logger.info("Extracting MP3 files...")
         mp3_dir.mkdir(parents=True, exist_ok=True)
         
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(mp3_dir)
+            members = [info.filename for info in zip_ref.infolist() if not info.is_dir()]
+        _parallel_extract(zip_path, [(m, str(mp3_dir / m)) for m in members])
         
         # Verify extraction
         mp3_files = list(mp3_dir.rglob("*.mp3"))
@@ -172,11 +466,34 @@ def download_dataset():
     return annotations_path
 
 
-def load_annotations(annotations_path: Path) -> pd.DataFrame:
-    """Load and parse MagnaTagATune annotations"""
+def load_annotations(annotations_path: Path, proxy_tags_only: bool = False) -> pd.DataFrame:
+    """Load and parse MagnaTagATune annotations
+    
+    Tag columns are 0/1 flags, so they are parsed straight into int8. Every
+    tag column is kept by default, since the training metadata records each
+    clip's full tag set (scoring only looks at the proxy tags either way).
+    proxy_tags_only parses just the proxy tag columns, for callers that
+    only need the scores.
+    """
     logger.info(f"Loading annotations from {annotations_path}")
     
-    df = pd.read_csv(annotations_path, sep='\t')
+    columns = pd.read_csv(annotations_path, sep='\t', nrows=0).columns
+    id_cols = {'clip_id', 'mp3_path'}
+    if proxy_tags_only:
+        wanted = [col for col in columns if col in id_cols] + _matched_cols(columns)
+    else:
+        wanted = list(columns)
+    
+    dtypes = {col: 'int8' for col in wanted if col not in id_cols}
+    dtypes.update(clip_id='int32', mp3_path='string')
+    
+    df = pd.read_csv(
+        annotations_path,
+        sep='\t',
+        usecols=wanted,
+        dtype=dtypes,
+        engine='pyarrow'
+    )
     
     logger.info(f"Loaded {len(df)} clips with {len(df.columns)} tag columns")
     
@@ -184,31 +501,148 @@ def load_annotations(annotations_path: Path) -> pd.DataFrame:
 
 
 def filter_amapiano_proxy_clips(df: pd.DataFrame) -> pd.DataFrame:
-    """Filter clips that match Amapiano proxy characteristics"""
+    """Filter clips that match Amapiano proxy characteristics
     
-    tag_columns = [col for col in df.columns if col not in ['clip_id', 'mp3_path']]
+    The returned frame carries a _tags column with each kept clip's tag names.
+    """
     
-    def count_matching_tags(row):
-        matching = 0
-        for tag in tag_columns:
-            if tag.lower() in AMAPIANO_PROXY_TAGS and row[tag] == 1:
-                matching += 1
-        return matching
+    tag_cols = [col for col in df.columns if col not in {'clip_id', 'mp3_path', 'amapiano_proxy_score'}]
+    tag_arr = np.asarray(tag_cols)
+    is_proxy = np.isin(tag_arr, _matched_cols(tag_cols))
     
-    df['amapiano_proxy_score'] = df.apply(count_matching_tags, axis=1)
+    # One ndarray of the 0/1 tag matrix serves both scoring and tag-list assembly;
+    # the score is a single matrix-vector product instead of a per-row Python loop
+    tag_matrix = df[tag_cols].to_numpy(dtype=np.int8, copy=False)
+    scores = tag_matrix @ is_proxy.astype(np.int16)
+    df['amapiano_proxy_score'] = scores
     
-    filtered = df[df['amapiano_proxy_score'] >= MIN_TAGS_MATCH].copy()
+    candidate_idx = np.flatnonzero(scores >= MIN_TAGS_MATCH)
     
-    filtered = filtered.sort_values('amapiano_proxy_score', ascending=False)
+    logger.info(f"Filtered to {len(candidate_idx)} clips with ≥{MIN_TAGS_MATCH} Amapiano proxy tags")
+    logger.info(f"Score distribution:\n{pd.Series(scores[candidate_idx], name='amapiano_proxy_score').value_counts().sort_index(ascending=False)}")
     
-    logger.info(f"Filtered to {len(filtered)} clips with ≥{MIN_TAGS_MATCH} Amapiano proxy tags")
-    logger.info(f"Score distribution:\n{filtered['amapiano_proxy_score'].value_counts().sort_index(ascending=False)}")
-    
-    if len(filtered) > TARGET_CLIPS:
-        filtered = filtered.head(TARGET_CLIPS)
+    top = candidate_idx
+    if len(candidate_idx) > TARGET_CLIPS:
+        # O(n) top-K selection; only the kept rows get sorted below
+        top = candidate_idx[np.argpartition(-scores[candidate_idx], TARGET_CLIPS)[:TARGET_CLIPS]]
+        top.sort()
         logger.info(f"Limited to top {TARGET_CLIPS} clips by proxy score")
     
-    return filtered
+    top_sorted = top[np.argsort(-scores[top], kind='stable')]
+    
+    tag_lists = [tag_arr[row].tolist() for row in tag_matrix[top_sorted].astype(bool)]
+    
+    return df.iloc[top_sorted].assign(_tags=tag_lists)
+
+
+def _metadata_row(clip_id: int, dest_file: Path, score: int, tags: List[str]) -> Dict:
+    return {
+        'clip_id': clip_id,
+        'file_path': str(dest_file.relative_to(OUTPUT_DIR)),
+        'amapiano_proxy_score': score,
+        'tags': tags,
+        'duration': 29.0
+    }
+
+
+def _write_training_metadata(metadata_rows: List[Dict], skipped_count: int,
+                             up_to_date_count: int = 0) -> Tuple[pd.DataFrame, Path]:
+    """Write training metadata (CSV + Parquet), log a summary and checkpoint
+    
+    up_to_date_count is how many of the rows' files were already in place
+    from an earlier run and were not copied again.
+    """
+    clip_count = len(metadata_rows)
+    copied_count = clip_count - up_to_date_count
+    
+    # Arrow's C++ writers serialize the rows directly, with no intermediate DataFrame
+    metadata_table = pa.Table.from_pylist(metadata_rows, schema=METADATA_SCHEMA)
+    metadata_path = OUTPUT_DIR / "training_metadata.csv"
+    tags_idx = metadata_table.schema.get_field_index('tags')
+    pacsv.write_csv(
+        metadata_table.set_column(tags_idx, 'tags', pc.binary_join(metadata_table['tags'], ',')),
+        metadata_path
+    )
+    
+    # Parquet copy keeps tags as a real list column so stats never re-split strings;
+    # the ~50 distinct tag strings are dictionary-encoded on disk and zstd-compressed
+    pq.write_table(
+        metadata_table,
+        metadata_path.with_suffix('.parquet'),
+        compression='zstd',
+        use_dictionary=True
+    )
+    
+    logger.info(f"\nCreated training subset:")
+    logger.info(f"  - {copied_count} audio files copied")
+    logger.info(f"  - {up_to_date_count} files already up to date (not re-copied)")
+    logger.info(f"  - {skipped_count} files skipped (not found)")
+    logger.info(f"  - Metadata saved to {metadata_path}")
+    logger.info(f"  - Estimated total duration: {clip_count * 29 / 3600:.1f} hours")
+    logger.info(f"  - Average file size: ~1.2 MB (MP3 @ 128kbps)")
+    logger.info(f"  - Total dataset size: ~{clip_count * 1.2 / 1024:.1f} GB")
+    
+    save_checkpoint('subset_created', {
+        'clips_copied': copied_count,
+        'clips_up_to_date': up_to_date_count,
+        'clips_skipped': skipped_count,
+        'metadata_path': str(metadata_path)
+    })
+    
+    return metadata_table.to_pandas(), metadata_path
+
+
+def extract_training_subset(filtered_df: pd.DataFrame, zip_path: Optional[Path] = None):
+    """Create training subset by extracting only the filtered clips from the MP3 archive
+    
+    Members are inflated straight to audio/{clip_id}.mp3, so the other ~18k
+    clips are never written to disk and no separate copy pass is needed.
+    Without zip_path the archive is streamed from MAGNATAGATUNE_ZIP_URL.
+    """
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    
+    audio_dir = OUTPUT_DIR / "audio"
+    audio_dir.mkdir(exist_ok=True)
+    
+    view = filtered_df[['clip_id', 'mp3_path', 'amapiano_proxy_score', '_tags']]
+    
+    # Archive file name -> (destination, metadata row), in proxy-score order
+    wanted = {}
+    for clip_id, mp3_path, score, tags in view.itertuples(index=False, name=None):
+        dest_file = audio_dir / f"{clip_id}.mp3"
+        wanted[Path(mp3_path).name] = (str(dest_file), _metadata_row(clip_id, dest_file, score, tags))
+    
+    if zip_path is not None:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            members = {
+                Path(info.filename).name: info.filename
+                for info in zip_ref.infolist() if not info.is_dir()
+            }
+        logger.info(f"Indexed {len(members)} MP3 files in {zip_path}")
+        
+        targets = [(members[name], dest) for name, (dest, _) in wanted.items() if name in members]
+        logger.info(f"Extracting {len(targets)} selected clips...")
+        written, up_to_date = _parallel_extract(zip_path, targets)
+        extracted = {Path(member).name for member in written}
+    else:
+        logger.info(f"Streaming {len(wanted)} selected clips from {MAGNATAGATUNE_ZIP_URL}...")
+        extracted = stream_extract_from_url(
+            MAGNATAGATUNE_ZIP_URL,
+            {name: dest for name, (dest, _) in wanted.items()}
+        )
+        up_to_date = 0  # streamed members are always rewritten
+    
+    metadata_rows = []
+    skipped_count = 0
+    for name, (_, row) in wanted.items():
+        if name in extracted:
+            metadata_rows.append(row)
+            continue
+        skipped_count += 1
+        if skipped_count <= 10:  # Only log first 10 missing files
+            logger.warning(f"Archive member not extracted (missing or unsafe): {name}")
+    
+    return _write_training_metadata(metadata_rows, skipped_count, up_to_date)
 
 
 def create_training_subset(filtered_df: pd.DataFrame, audio_source_dir: Path):
@@ -219,73 +653,54 @@ def create_training_subset(filtered_df: pd.DataFrame, audio_source_dir: Path):
     audio_dir.mkdir(exist_ok=True)
     
     # Build file lookup map for faster searching
-    all_mp3s = {f.name: f for f in audio_source_dir.rglob("*.mp3")}
+    all_mp3s = load_mp3_index(audio_source_dir)
     logger.info(f"Built lookup map for {len(all_mp3s)} MP3 files")
     
-    metadata_rows = []
-    copied_count = 0
+    copy_jobs = []
     skipped_count = 0
     
-    logger.info(f"Copying {len(filtered_df)} audio files...")
+    # Plain tuples over just the needed columns avoid boxing every row into a Series
+    view = filtered_df[['clip_id', 'mp3_path', 'amapiano_proxy_score', '_tags']]
     
-    for idx, row in tqdm(filtered_df.iterrows(), total=len(filtered_df), desc="Copying audio"):
-        clip_id = row.get('clip_id', idx)
-        
-        mp3_path = row.get('mp3_path', f"{clip_id}.mp3")
-        mp3_filename = Path(mp3_path).name
-        
-        # Try direct path first, then lookup map
-        source_file = audio_source_dir / mp3_path
-        if not source_file.exists() and mp3_filename in all_mp3s:
-            source_file = all_mp3s[mp3_filename]
+    for clip_id, mp3_path, score, tags in view.itertuples(index=False, name=None):
+        # The index already records every file on disk, so no per-clip stat() is needed
+        source_file = all_mp3s.get(Path(mp3_path).name)
         
-        if source_file.exists():
+        if source_file is not None:
             dest_file = audio_dir / f"{clip_id}.mp3"
-            shutil.copy2(source_file, dest_file)
-            
-            tag_list = [col for col in filtered_df.columns 
-                       if col not in ['clip_id', 'mp3_path', 'amapiano_proxy_score'] 
-                       and row[col] == 1]
-            
-            metadata_rows.append({
-                'clip_id': clip_id,
-                'file_path': str(dest_file.relative_to(OUTPUT_DIR)),
-                'amapiano_proxy_score': row['amapiano_proxy_score'],
-                'tags': ','.join(tag_list),
-                'duration': 29.0
-            })
-            
-            copied_count += 1
+            copy_jobs.append((source_file, dest_file, _metadata_row(clip_id, dest_file, score, tags)))
         else:
             skipped_count += 1
             if skipped_count <= 10:  # Only log first 10 missing files
-                logger.warning(f"Source file not found: {source_file}")
+                logger.warning(f"Source file not found: {audio_source_dir / mp3_path}")
     
-    metadata_df = pd.DataFrame(metadata_rows)
-    metadata_path = OUTPUT_DIR / "training_metadata.csv"
-    metadata_df.to_csv(metadata_path, index=False)
+    logger.info(f"Copying {len(copy_jobs)} audio files...")
     
-    logger.info(f"\nCreated training subset:")
-    logger.info(f"  - {copied_count} audio files copied")
-    logger.info(f"  - {skipped_count} files skipped (not found)")
-    logger.info(f"  - Metadata saved to {metadata_path}")
-    logger.info(f"  - Estimated total duration: {copied_count * 29 / 3600:.1f} hours")
-    logger.info(f"  - Average file size: ~1.2 MB (MP3 @ 128kbps)")
-    logger.info(f"  - Total dataset size: ~{copied_count * 1.2 / 1024:.1f} GB")
-    
-    save_checkpoint('subset_created', {
-        'clips_copied': copied_count,
-        'clips_skipped': skipped_count,
-        'metadata_path': str(metadata_path)
-    })
-    
-    return metadata_path
+    # Copies are I/O-bound and release the GIL, so threads keep the disk queue full
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_copy_if_changed, src, dst) for src, dst, _ in copy_jobs]
+        
+        # Refresh the bar every PROGRESS_BATCH files rather than once per copy
+        progress_bar = tqdm(total=len(futures), desc="Copying audio")
+        up_to_date = 0
+        reported = 0
+        for done, future in enumerate(as_completed(futures), 1):
+            up_to_date += not future.result()
+            if done % PROGRESS_BATCH == 0:
+                progress_bar.update(done - reported)
+                reported = done
+        progress_bar.update(len(futures) - reported)
+        progress_bar.close()
+    
+    # Rows stay in proxy-score order regardless of copy completion order
+    metadata_rows = [row for _, _, row in copy_jobs]
+    
+    return _write_training_metadata(metadata_rows, skipped_count, up_to_date)
 
 
-def generate_training_stats(metadata_path: Path):
+def generate_training_stats(df: pd.DataFrame):
     """Generate statistics about the training dataset"""
-    df = pd.read_csv(metadata_path)
-    
     logger.info("\n" + "="*60)
     logger.info("AMAPIANO PROXY TRAINING DATASET STATISTICS")
     logger.info("="*60)
@@ -294,15 +709,10 @@ def generate_training_stats(metadata_path: Path):
     logger.info(f"\nProxy score distribution:")
     logger.info(df['amapiano_proxy_score'].value_counts().sort_index(ascending=False))
     
-    all_tags = []
-    for tags_str in df['tags']:
-        all_tags.extend(tags_str.split(','))
-    
-    from collections import Counter
-    tag_counts = Counter(all_tags)
+    tag_counts = df['tags'].explode().value_counts().head(20)
     
     logger.info(f"\nTop 20 most common tags:")
-    for tag, count in tag_counts.most_common(20):
+    for tag, count in tag_counts.items():
         logger.info(f"  {tag}: {count} ({count/len(df)*100:.1f}%)")
     
     logger.info("="*60 + "\n")
@@ -313,34 +723,29 @@ def main():
     logger.info("MagnaTagATune Dataset Setup for Amapiano Proxy Training")
     logger.info("="*60)
     
-    annotations_path = download_dataset()
+    annotations_path = download_annotations()
     
     df = load_annotations(annotations_path)
     
     filtered_df = filter_amapiano_proxy_clips(df)
     
     audio_source_dir = DATASET_DIR / "mp3"
-    if not audio_source_dir.exists():
-        logger.error(f"Audio source directory not found: {audio_source_dir}")
-        logger.error("Run download_dataset() first to fetch the dataset")
-        return
-    
-    mp3_count = len(list(audio_source_dir.rglob("*.mp3")))
-    if mp3_count == 0:
-        logger.error("No MP3 files found in audio source directory!")
-        logger.error("The download may have failed. Try deleting the mp3/ folder and re-running.")
-        return
-    
-    logger.info(f"Found {mp3_count} MP3 files for processing")
-    
-    # Flatten directory structure if needed (HuggingFace zip may have subdirs)
-    mp3_files = list(audio_source_dir.rglob("*.mp3"))
-    if mp3_files:
-        logger.info(f"Found {len(mp3_files)} MP3 files in {audio_source_dir}")
-    
-    metadata_path = create_training_subset(filtered_df, audio_source_dir)
+    if audio_source_dir.exists() and any(audio_source_dir.rglob("*.mp3")):
+        # Fully extracted tree from an earlier download_dataset() run
+        logger.info(f"Copying subset from extracted MP3 files in {audio_source_dir}")
+        metadata_df, metadata_path = create_training_subset(filtered_df, audio_source_dir)
+    elif STREAM_EXTRACT and not (DATASET_DIR / "mp3.zip").exists():
+        if not STREAM_UNZIP_AVAILABLE:
+            logger.error("AMAPIANO_STREAM_EXTRACT=1 requires stream-unzip (pip install stream-unzip)")
+            return
+        metadata_df, metadata_path = extract_training_subset(filtered_df)
+    else:
+        # Filtering runs first, so only the selected clips are ever extracted.
+        # The archive is kept so the subset can be re-filtered without re-downloading.
+        zip_path = download_mp3_archive()
+        metadata_df, metadata_path = extract_training_subset(filtered_df, zip_path)
     
-    generate_training_stats(metadata_path)
+    generate_training_stats(metadata_df)
     
     logger.info("\nDataset setup complete!")
     logger.info(f"Training metadata: {metadata_path}")
@@ -136,6 +136,22 @@ if [ $? -ne 0 ]; then
     exit 1
 fi
 
+echo "Packing audio into clips.bin..."
+python3 pack_dataset.py
+
+if [ $? -ne 0 ]; then
+    echo "Error: Audio packing failed"
+    exit 1
+fi
+
+echo "Precomputing EnCodec tokens..."
+python3 precompute_codes.py
+
+if [ $? -ne 0 ]; then
+    echo "Error: Token precomputation failed"
+    exit 1
+fi
+
 echo "✓ Dataset ready"
 echo ""
 
@@ -152,10 +168,11 @@ cat > config.json << EOF
   "dataset_dir": "./datasets/amapiano_proxy",
   "checkpoint_dir": "./checkpoints/phase_2_5",
   "tensorboard_dir": "./runs/phase_2_5",
-  "batch_size": 8,
+  "batch_size": 16,
   "learning_rate": 1e-5,
   "num_epochs": 20,
-  "gradient_accumulation_steps": 4,
+  "gradient_accumulation_steps": 2,
+  "use_grad_checkpointing": true,
   "warmup_steps": 500,
   "save_every_n_steps": 1000,
   "eval_every_n_steps": 500,
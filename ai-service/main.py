@@ -6,11 +6,11 @@ Deployment: AWS EC2 g4dn.xlarge (NVIDIA T4 GPU) or similar
 Requirements: CUDA 11.8+, Python 3.10+, 16GB+ GPU RAM
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File
+from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, Field
-from typing import Optional, List, Literal
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter
+from typing import Optional, List, Literal, Tuple, Union
 import torch
 import torchaudio
 from pathlib import Path
@@ -18,6 +18,14 @@ import uuid
 import logging
 from datetime import datetime
 import asyncio
+import aiofiles
+import functools
+import json
+import os
+import time
+import struct
+import wave
+from dataclasses import dataclass, field
 from enum import Enum
 
 # AI Model Imports
@@ -30,6 +38,19 @@ except ImportError:
     MODELS_AVAILABLE = False
     logging.warning("AI models not available - running in demo mode")
 
+try:
+    import xxhash
+    XXHASH_AVAILABLE = True
+except ImportError:
+    import hashlib
+    XXHASH_AVAILABLE = False
+
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -57,6 +78,39 @@ app.add_middleware(
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 logger.info(f"Using device: {DEVICE}")
 
+def _pick_inference_dtype() -> torch.dtype:
+    """bf16 on Ampere+ (sm_80), fp16 on older GPUs such as the T4, fp32 on CPU"""
+    if DEVICE != "cuda":
+        return torch.float32
+    major, _ = torch.cuda.get_device_capability()
+    return torch.bfloat16 if major >= 8 else torch.float16
+
+INFERENCE_DTYPE = _pick_inference_dtype()
+logger.info(f"Inference dtype: {INFERENCE_DTYPE}")
+
+# NF4 4-bit LM via bitsandbytes (see optimize_model.py)
+USE_INT4 = os.environ.get("USE_INT4") == "1" and DEVICE == "cuda"
+
+# torch.compile the MusicGen LM and Demucs forwards (opt-in: first requests pay compile time)
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE") == "1" and DEVICE == "cuda"
+if TORCH_COMPILE:
+    # Persist compiled kernels across restarts (mount as a volume in Docker)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", "/var/cache/inductor")
+
+# htdemucs_ft bags four per-source models, which separate() runs on parallel CUDA streams
+DEMUCS_MODEL = os.environ.get("DEMUCS_MODEL", "htdemucs")
+# Passed to every demucs apply_model() call; part of the stem cache key
+DEMUCS_APPLY_PARAMS = {
+    "shifts": int(os.environ.get("DEMUCS_SHIFTS", "1")),
+    "split": True,
+    "overlap": float(os.environ.get("DEMUCS_OVERLAP", "0.25")),
+}
+
+# safetensors LM export from optimize_model.export_lm_weights
+MUSICGEN_WEIGHTS = Path(os.environ.get(
+    "MUSICGEN_WEIGHTS", "./models/optimized/facebook_musicgen-medium_lm.safetensors"
+))
+
 # Storage paths
 UPLOAD_DIR = Path("./uploads")
 OUTPUT_DIR = Path("./outputs")
@@ -65,6 +119,63 @@ STEMS_DIR = Path("./stems")
 for directory in [UPLOAD_DIR, OUTPUT_DIR, STEMS_DIR]:
     directory.mkdir(exist_ok=True)
 
+UPLOAD_CHUNK_SIZE = 1 << 20
+STEM_NAMES = ["drums", "bass", "other", "vocals"]
+
+def _upload_hasher():
+    """Fast content hash for uploads: xxh3-128 when available, else BLAKE2b-128"""
+    if XXHASH_AVAILABLE:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+def stem_cache_key(digest: str) -> str:
+    """
+    Cache key for an upload's stems: the separator configuration plus its content hash
+    
+    Changing DEMUCS_MODEL or the apply_model settings yields new keys, so
+    stems made by a different separator are never served from the cache.
+    """
+    params = DEMUCS_APPLY_PARAMS
+    return f"{DEMUCS_MODEL}-s{params['shifts']}-o{params['overlap']}-{digest}"
+
+def _stem_url(stem_key: str, name: str) -> str:
+    return f"/download/stems/{stem_key}_{name}.wav"
+
+def _no_log_drums_marker(stem_key: str) -> Path:
+    """Empty file recording that log drum detection ran and found none"""
+    return STEMS_DIR / f"{stem_key}_log_drums.none"
+
+def cached_stems(stem_key: str, detect_log_drums: bool) -> Optional[dict[str, str]]:
+    """
+    Stem URLs for an already-separated upload, or None if any are missing
+    
+    With detect_log_drums, the upload also needs a recorded detection
+    result: either the log_drums stem or the no-log-drums marker.
+    """
+    if not all((STEMS_DIR / f"{stem_key}_{name}.wav").exists() for name in STEM_NAMES):
+        return None
+    stem_paths = {name: _stem_url(stem_key, name) for name in STEM_NAMES}
+    if detect_log_drums:
+        if (STEMS_DIR / f"{stem_key}_log_drums.wav").exists():
+            stem_paths["log_drums"] = _stem_url(stem_key, "log_drums")
+        elif not _no_log_drums_marker(stem_key).exists():
+            return None
+    return stem_paths
+
+def _save_wav_atomic(path: Path, wav: torch.Tensor, sample_rate: int):
+    """Write a WAV under a temp name and rename, so readers never see partial stems"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    torchaudio.save(str(tmp_path), wav, sample_rate=sample_rate, format="wav")
+    os.replace(tmp_path, path)
+
+# When served behind nginx, set to its internal location prefix (e.g. /protected)
+# so downloads are handed off via X-Accel-Redirect and sent by the kernel
+ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX")
+AUDIO_DOWNLOAD_HEADERS = {
+    "Accept-Ranges": "bytes",
+    "Cache-Control": "public, max-age=86400",
+}
+
 # Job queue and status tracking
 class JobStatus(str, Enum):
     QUEUED = "queued"
@@ -72,23 +183,175 @@ class JobStatus(str, Enum):
     COMPLETED = "completed"
     FAILED = "failed"
 
-class Job(BaseModel):
+@dataclass(slots=True)
+class Job:
+    """Internal job state; plain attributes so progress updates skip validation"""
     job_id: str
     status: JobStatus
+    created_at: datetime
     progress: float = 0.0
-    result_url: Optional[str] = None
+    result_url: Optional[Union[str, dict[str, str]]] = None
     error: Optional[str] = None
-    created_at: datetime
     completed_at: Optional[datetime] = None
 
-jobs: dict[str, Job] = {}
+# (De)serializes Job for Redis
+_JOB_ADAPTER = TypeAdapter(Job)
+
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", "3600"))
+REDIS_URL = os.environ.get("REDIS_URL")
+
+class JobStore:
+    """
+    Job state with TTL expiry
+    
+    Jobs owned by this process live in a local dict so background tasks can
+    update them in place; finished jobs are evicted after the TTL. When
+    REDIS_URL is set every save is also written to Redis with the same
+    expiry, so /status works from any replica. Each save also wakes any
+    WebSocket watchers of that job.
+    """
+    
+    def __init__(self, ttl: int, redis_url: Optional[str] = None):
+        self.ttl = ttl
+        self._local: dict[str, Job] = {}
+        self._expires: dict[str, float] = {}
+        self._events: dict[str, asyncio.Event] = {}
+        self._redis = None
+        if redis_url:
+            if REDIS_AVAILABLE:
+                self._redis = aioredis.from_url(redis_url)
+            else:
+                logging.warning("REDIS_URL set but redis is not installed - job state stays in-process")
+    
+    def __getitem__(self, job_id: str) -> Job:
+        return self._local[job_id]
+    
+    def values(self):
+        return self._local.values()
+    
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [
+            job_id for job_id, expires in self._expires.items()
+            if expires < now and self._local[job_id].status in (JobStatus.COMPLETED, JobStatus.FAILED)
+        ]
+        for job_id in expired:
+            del self._local[job_id]
+            del self._expires[job_id]
+            self._events.pop(job_id, None)
+    
+    async def save(self, job: Job):
+        """Record a job (or its latest state) and refresh its expiry"""
+        self._evict_expired()
+        self._local[job.job_id] = job
+        self._expires[job.job_id] = time.monotonic() + self.ttl
+        if self._redis is not None:
+            await self._redis.set(f"job:{job.job_id}", _JOB_ADAPTER.dump_json(job), ex=self.ttl)
+        event = self._events.pop(job.job_id, None)
+        if event is not None:
+            event.set()
+    
+    def update_event(self, job_id: str) -> asyncio.Event:
+        """Event set by the next save of this job"""
+        return self._events.setdefault(job_id, asyncio.Event())
+    
+    def release_event(self, job_id: str):
+        """
+        Drop the update event of a job owned by another replica
+        
+        No local save ever pops those events and the TTL eviction only
+        sees local jobs, so watchers release them when they stop watching.
+        Events of local jobs are left for save() to set.
+        """
+        if job_id not in self._local:
+            self._events.pop(job_id, None)
+    
+    async def fetch(self, job_id: str) -> Optional[Job]:
+        """Look up a job locally, falling back to Redis for jobs owned by other replicas"""
+        job = self._local.get(job_id)
+        if job is not None or self._redis is None:
+            return job
+        raw = await self._redis.get(f"job:{job_id}")
+        return _JOB_ADAPTER.validate_json(raw) if raw else None
+
+jobs = JobStore(JOB_TTL_SECONDS, REDIS_URL)
+
+# Side stream for host<->device copies so they overlap with compute
+_copy_stream = torch.cuda.Stream() if DEVICE == "cuda" else None
+
+def _to_device_async(wav: torch.Tensor) -> torch.Tensor:
+    """Pin and upload a CPU tensor on the copy stream, ordered before later compute"""
+    if _copy_stream is None:
+        return wav.to(DEVICE)
+    wav = wav.pin_memory()
+    with torch.cuda.stream(_copy_stream):
+        wav_gpu = wav.to(DEVICE, non_blocking=True)
+    torch.cuda.current_stream().wait_stream(_copy_stream)
+    return wav_gpu
+
+def _to_host_async(tensors: List[torch.Tensor]):
+    """
+    Start device->host copies on the copy stream; returns (cpu tensors, completion event)
+    
+    Non-blocking D2H copies land in pinned memory from PyTorch's caching host
+    allocator, so staging buffers are pooled and reused across concurrent
+    jobs instead of being re-pinned per request.
+    """
+    if _copy_stream is None:
+        return [t.cpu() for t in tensors], None
+    _copy_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(_copy_stream):
+        host = [t.to("cpu", non_blocking=True) for t in tensors]
+        done = torch.cuda.Event()
+        done.record()
+    return host, done
+
+# Resample kernels are expensive to build; keep one per rate pair on DEVICE
+_RESAMPLERS: dict[Tuple[int, int], torchaudio.transforms.Resample] = {}
+
+def get_resampler(src_sr: int, dst_sr: int) -> torchaudio.transforms.Resample:
+    """Return a cached resampler for src_sr -> dst_sr"""
+    key = (src_sr, dst_sr)
+    resampler = _RESAMPLERS.get(key)
+    if resampler is None:
+        resampler = torchaudio.transforms.Resample(src_sr, dst_sr).to(DEVICE)
+        _RESAMPLERS[key] = resampler
+    return resampler
 
 # ===== AI MODEL INITIALIZATION =====
 
+def load_musicgen_from_safetensors(weights_path: Path) -> "MusicGen":
+    """
+    Build MusicGen from a safetensors LM export
+    
+    The LM skeleton is created from the exported config and the weights are
+    memory-mapped and loaded directly onto DEVICE, skipping the pickle
+    checkpoint and its CPU staging copy.
+    """
+    from omegaconf import OmegaConf
+    from audiocraft.models import builders
+    from audiocraft.models.loaders import load_compression_model
+    from safetensors.torch import load_model
+    
+    meta = json.loads(weights_path.with_suffix('.json').read_text())
+    cfg = OmegaConf.create(meta['lm_cfg'])
+    cfg.device = DEVICE
+    cfg.dtype = 'float32' if DEVICE == 'cpu' else 'float16'
+    
+    lm = builders.get_lm_model(cfg)
+    load_model(lm, str(weights_path), device=DEVICE)
+    lm.eval()
+    lm.cfg = cfg
+    
+    compression_model = load_compression_model(meta['base_model'], device=DEVICE)
+    return MusicGen(meta['base_model'], compression_model, lm)
+
 class AIModels:
     def __init__(self):
         self.musicgen = None
         self.demucs = None
+        self.demucs_streams: List[torch.cuda.Stream] = []
+        self._last_params: Optional[Tuple[int, float, int]] = None
         self.initialized = False
     
     async def initialize(self):
@@ -99,11 +362,33 @@ class AIModels:
         
         try:
             logger.info("Loading MusicGen model...")
-            self.musicgen = MusicGen.get_pretrained('facebook/musicgen-medium', device=DEVICE)
-            self.musicgen.set_generation_params(duration=30, temperature=0.8, top_k=250)
+            if MUSICGEN_WEIGHTS.exists():
+                self.musicgen = load_musicgen_from_safetensors(MUSICGEN_WEIGHTS)
+            else:
+                self.musicgen = MusicGen.get_pretrained('facebook/musicgen-medium', device=DEVICE)
+            self.set_generation_params(30, 0.8, 250)
+            if USE_INT4:
+                from optimize_model import replace_linear_with_4bit
+                logger.info("Quantizing MusicGen LM to NF4...")
+                replace_linear_with_4bit(self.musicgen.lm, compute_dtype=INFERENCE_DTYPE)
+                self.musicgen.lm.to(DEVICE)
+            elif INFERENCE_DTYPE != torch.float32:
+                self.musicgen.lm.to(dtype=INFERENCE_DTYPE)
+            if INFERENCE_DTYPE != torch.float32:
+                self.musicgen.compression_model.to(dtype=INFERENCE_DTYPE)
+            self.enable_sdpa_attention()
             
             logger.info("Loading Demucs model...")
-            self.demucs = pretrained.get_model('htdemucs').to(DEVICE)
+            self.demucs = pretrained.get_model(DEMUCS_MODEL).to(DEVICE)
+            bag = getattr(self.demucs, "models", [])
+            if DEVICE == "cuda" and len(bag) > 1:
+                self.demucs_streams = [torch.cuda.Stream() for _ in bag]
+            
+            if TORCH_COMPILE:
+                self.compile_models()
+            
+            logger.info("Warming up models...")
+            await asyncio.to_thread(self.warmup)
             
             self.initialized = True
             logger.info("AI models initialized successfully")
@@ -111,8 +396,306 @@ class AIModels:
             logger.error(f"Failed to initialize models: {e}")
             raise
 
+    def enable_sdpa_attention(self):
+        """
+        Route every LM attention layer through torch's fused
+        scaled_dot_product_attention
+        
+        audiocraft's StreamingMultiheadAttention already has an SDPA path
+        (memory_efficient with the 'torch' backend) that keeps its KV-cache
+        streaming logic intact, so it is switched on rather than replacing
+        forward().
+        """
+        from audiocraft.modules.transformer import (
+            StreamingMultiheadAttention,
+            set_efficient_attention_backend,
+        )
+        set_efficient_attention_backend('torch')
+        patched = 0
+        for module in self.musicgen.lm.modules():
+            if isinstance(module, StreamingMultiheadAttention):
+                module.memory_efficient = True
+                patched += 1
+        logger.info(f"SDPA attention enabled on {patched} layers")
+    
+    def compile_models(self):
+        """
+        Wrap the per-step forwards with torch.compile
+        
+        MusicGen calls lm.generate(), which invokes the module's forward once
+        per decode step, so the forward is compiled rather than the module.
+        The KV cache length grows every step; dynamic shapes keep that from
+        recompiling per token. Demucs runs fixed-length segments through each
+        model in the bag, so those compile with static shapes.
+        """
+        logger.info("Compiling models with torch.compile...")
+        if not USE_INT4:
+            lm = self.musicgen.lm
+            lm.forward = torch.compile(lm.forward, dynamic=True)
+        for model in getattr(self.demucs, "models", [self.demucs]):
+            model.forward = torch.compile(model.forward, mode="max-autotune", dynamic=False)
+    
+    def warmup(self):
+        """
+        Run one short generation and separation so kernel selection, CUDA
+        context setup and allocator growth happen before the first request
+        """
+        start = time.perf_counter()
+        _generate_batch(["warmup"], 5, 0.8, 250)
+        with torch.inference_mode():
+            self.separate(torch.zeros(1, 2, int(self.demucs.samplerate * 5), device=DEVICE))
+        if DEVICE == "cuda":
+            torch.cuda.synchronize()
+        logger.info(f"Warmup finished in {time.perf_counter() - start:.1f}s")
+
+    def set_generation_params(self, duration: int, temperature: float, top_k: int):
+        """Reconfigure MusicGen sampling only when the params actually change"""
+        params = (duration, temperature, top_k)
+        if params != self._last_params:
+            self.musicgen.set_generation_params(
+                duration=duration,
+                temperature=temperature,
+                top_k=top_k
+            )
+            self._last_params = params
+    
+    def separate(self, mix: torch.Tensor) -> torch.Tensor:
+        """
+        Separate a (B, C, N) mix into (B, sources, C, N)
+        
+        A bag of independent models (e.g. htdemucs_ft) is launched with one
+        CUDA stream per member so their kernels overlap, then combined with
+        the bag's per-source weights exactly as demucs' apply_model does.
+        """
+        bag = getattr(self.demucs, "models", None)
+        if not self.demucs_streams or bag is None:
+            return apply_model(self.demucs, mix, **DEMUCS_APPLY_PARAMS)
+        
+        main_stream = torch.cuda.current_stream()
+        outs = []
+        for sub_model, stream in zip(bag, self.demucs_streams):
+            stream.wait_stream(main_stream)
+            with torch.cuda.stream(stream):
+                mix.record_stream(stream)
+                outs.append(apply_model(sub_model, mix, **DEMUCS_APPLY_PARAMS))
+        
+        for out, stream in zip(outs, self.demucs_streams):
+            main_stream.wait_stream(stream)
+            out.record_stream(main_stream)
+        
+        weights = torch.tensor(self.demucs.weights, device=mix.device, dtype=mix.dtype)
+        estimates = (torch.stack(outs) * weights[:, None, :, None, None]).sum(0)
+        return estimates / weights.sum(0)[None, :, None, None]
+
 ai_models = AIModels()
 
+# ===== BATCHED GENERATION =====
+
+MAX_GEN_BATCH = int(os.environ.get("MUSICGEN_MAX_BATCH", "4"))
+GEN_BATCH_WINDOW_S = 0.05  # let near-simultaneous requests join the same GPU pass
+
+@dataclass
+class GenerationItem:
+    prompt: str
+    params: Tuple[int, float, int]  # (duration, temperature, top_k)
+    future: asyncio.Future
+    audio_prompt: Optional[torch.Tensor] = None  # (C, T) tail to continue from
+    
+    @property
+    def batch_key(self):
+        """Items sharing this key can run in one generate call"""
+        prompt_len = None if self.audio_prompt is None else self.audio_prompt.shape[-1]
+        return (*self.params, prompt_len)
+
+_gen_queue: Optional[asyncio.Queue] = None
+
+def _generate_batch(
+    prompts: List[str],
+    duration: int,
+    temperature: float,
+    top_k: int,
+    audio_prompts: Optional[List[torch.Tensor]] = None
+) -> torch.Tensor:
+    """
+    Run one MusicGen pass over a batch of prompts sharing generation params
+    
+    With audio_prompts (equal-length tails) the batch continues that audio
+    and only the `duration` seconds of new audio are returned.
+    """
+    sample_rate = ai_models.musicgen.sample_rate
+    prompt_samples = audio_prompts[0].shape[-1] if audio_prompts else 0
+    # Continuation output includes the prompt, so extend the target length
+    ai_models.set_generation_params(duration + prompt_samples / sample_rate, temperature, top_k)
+    with torch.inference_mode(), torch.autocast(
+        DEVICE, dtype=INFERENCE_DTYPE, enabled=INFERENCE_DTYPE != torch.float32
+    ):
+        if audio_prompts:
+            wav = ai_models.musicgen.generate_continuation(
+                torch.stack(audio_prompts).to(DEVICE),
+                prompt_sample_rate=sample_rate,
+                descriptions=prompts
+            )[..., prompt_samples:]
+        else:
+            wav = ai_models.musicgen.generate(prompts)
+    # torchaudio.save expects fp32 samples; stage the whole batch to host in one copy
+    (host_wav,), copy_done = _to_host_async([wav.float()])
+    if copy_done is not None:
+        copy_done.synchronize()
+    return host_wav
+
+async def generation_batch_worker():
+    """
+    Single consumer that owns the MusicGen model
+    
+    Drains up to MAX_GEN_BATCH queued prompts, groups them by generation
+    params and generates each group in one batched call, so concurrent
+    requests share a GPU pass instead of serializing at batch size 1.
+    """
+    while True:
+        items = [await _gen_queue.get()]
+        await asyncio.sleep(GEN_BATCH_WINDOW_S)
+        while len(items) < MAX_GEN_BATCH:
+            try:
+                items.append(_gen_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        
+        groups: dict[tuple, List[GenerationItem]] = {}
+        for item in items:
+            groups.setdefault(item.batch_key, []).append(item)
+        
+        for key, group in groups.items():
+            params = group[0].params
+            audio_prompts = None
+            if group[0].audio_prompt is not None:
+                audio_prompts = [item.audio_prompt for item in group]
+            logger.info(f"Generating batch of {len(group)} prompt(s) with params {key}")
+            try:
+                wavs = await asyncio.to_thread(
+                    _generate_batch, [item.prompt for item in group], *params, audio_prompts
+                )
+            except Exception as e:
+                for item in group:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+            
+            for item, wav in zip(group, wavs):
+                if not item.future.done():
+                    item.future.set_result(wav)
+
+async def submit_generation(
+    prompt: str,
+    duration: int,
+    temperature: float,
+    top_k: int,
+    audio_prompt: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """Queue a prompt (optionally continuing audio_prompt) for the batching worker and wait for its waveform"""
+    future = asyncio.get_running_loop().create_future()
+    await _gen_queue.put(
+        GenerationItem(prompt, (duration, temperature, top_k), future, audio_prompt)
+    )
+    return await future
+
+# ===== WINDOWED GENERATION =====
+
+MUSICGEN_SINGLE_PASS_S = 30  # MusicGen's trained context; anything up to this is one generate() call
+STREAM_WINDOW_S = 10  # longer generations are produced and streamed in windows of this size
+CONTINUATION_OVERLAP_S = 3  # audio context carried into each continuation window
+WAV_HEADER_BYTES = 44  # canonical PCM header written by the wave module
+
+@dataclass(slots=True)
+class LiveStream:
+    """Progress of a windowed generation being appended to disk"""
+    path: Path
+    sample_rate: int
+    channels: int
+    bytes_written: int = 0
+    done: bool = False
+    updated: asyncio.Event = field(default_factory=asyncio.Event)
+    
+    def notify(self):
+        event, self.updated = self.updated, asyncio.Event()
+        event.set()
+
+_live_streams: dict[str, LiveStream] = {}
+
+def _to_pcm16(wav: torch.Tensor) -> bytes:
+    """(C, T) float waveform -> interleaved little-endian int16 frames"""
+    return (wav.clamp(-1, 1) * 32767).to(torch.int16).T.contiguous().numpy().tobytes()
+
+def _streaming_wav_header(sample_rate: int, channels: int) -> bytes:
+    """PCM16 WAV header with open-ended sizes for progressive playback"""
+    byte_rate = sample_rate * channels * 2
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, byte_rate, channels * 2, 16)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
+def _open_wav_writer(path: Path, sample_rate: int, channels: int) -> Tuple[wave.Wave_write, object]:
+    """PCM16 wave writer over a raw file handle that _append_frames can flush"""
+    raw = open(path, "wb")
+    out = wave.open(raw, "wb")
+    out.setnchannels(channels)
+    out.setsampwidth(2)
+    out.setframerate(sample_rate)
+    return out, raw
+
+def _close_wav_writer(out: wave.Wave_write, raw):
+    """Patch the final header sizes and close the file"""
+    out.close()
+    raw.close()
+
+def _append_frames(out: wave.Wave_write, raw, pcm: bytes):
+    """Append frames (wave re-patches the header sizes) and flush for live readers"""
+    out.writeframes(pcm)
+    raw.flush()
+
+async def generate_in_windows(job: "Job", prompt: str, request: "MusicGenRequest", output_path: Path):
+    """
+    Generate a track longer than one MusicGen pass as rolling windows, appending each to output_path
+    
+    The first window is a normal generation; every later window continues
+    from the last CONTINUATION_OVERLAP_S seconds. Each window goes through
+    the batching queue, so other jobs get the GPU between windows, and
+    /stream/{job_id}.wav can play the track while it is still being made.
+    Job progress advances from its current value up to 0.9 as windows land.
+    """
+    sample_rate = ai_models.musicgen.sample_rate
+    channels = ai_models.musicgen.audio_channels
+    overlap = CONTINUATION_OVERLAP_S * sample_rate
+    start_progress = job.progress
+    
+    out, raw = await asyncio.to_thread(_open_wav_writer, output_path, sample_rate, channels)
+    stream = LiveStream(output_path, sample_rate, channels)
+    _live_streams[job.job_id] = stream
+    
+    try:
+        generated = 0
+        tail = None
+        while generated < request.duration:
+            window = min(STREAM_WINDOW_S, request.duration - generated)
+            wav = await submit_generation(
+                prompt, window, request.temperature, request.top_k, audio_prompt=tail
+            )
+            tail = torch.cat([tail, wav], dim=-1)[..., -overlap:] if tail is not None else wav[..., -overlap:]
+            
+            pcm = _to_pcm16(wav)
+            await asyncio.to_thread(_append_frames, out, raw, pcm)
+            stream.bytes_written += len(pcm)
+            stream.notify()
+            
+            generated += window
+            job.progress = start_progress + (0.9 - start_progress) * generated / request.duration
+            await jobs.save(job)
+    finally:
+        await asyncio.to_thread(_close_wav_writer, out, raw)
+        stream.done = True
+        stream.notify()
+        _live_streams.pop(job.job_id, None)
+
 # ===== REQUEST/RESPONSE MODELS =====
 
 class MusicGenRequest(BaseModel):
@@ -282,63 +865,68 @@ def calculate_spectral_slope(magnitude: torch.Tensor, freq_bins: torch.Tensor) -
     # Calculate slope in dB per octave (log frequency)
     log_freq = torch.log2(freq_bins[1:] + 1e-8)
     
-    # Linear regression
-    slope = torch.polyfit(log_freq, spectrum_db[1:], deg=1)[0]
+    # Least-squares line fit: slope = cov(x, y) / var(x)
+    x = log_freq - log_freq.mean()
+    y = spectrum_db[1:] - spectrum_db[1:].mean()
+    slope = (x * y).sum() / (x * x).sum()
     
     return slope.item()
 
 # ===== CULTURAL ENHANCEMENT =====
 
+_CULTURAL_ELEMENTS = {
+    "amapiano": {
+        "traditional": [
+            "deep log drum basslines",
+            "soulful South African piano melodies",
+            "Kwaito-influenced percussion",
+            "gospel-rooted harmonies",
+            "authentic township groove"
+        ],
+        "modern": [
+            "contemporary amapiano production",
+            "electronic log drum synthesis",
+            "modern South African house feel",
+            "urban amapiano style"
+        ],
+        "fusion": [
+            "amapiano with international influences",
+            "cross-cultural rhythmic fusion",
+            "blended traditional and modern elements"
+        ]
+    },
+    "private_school_amapiano": {
+        "traditional": [
+            "jazz-influenced chord progressions",
+            "sophisticated harmonic structure",
+            "live instrument feel",
+            "refined South African musicianship",
+            "subtle percussive textures"
+        ],
+        "modern": [
+            "contemporary private school production",
+            "polished jazz-amapiano fusion",
+            "sophisticated urban sound"
+        ],
+        "fusion": [
+            "private school with global jazz elements",
+            "refined cross-cultural sophistication"
+        ]
+    }
+}
+
+# Pre-joined style text per (genre, authenticity)
+_ENHANCEMENT_BY_KEY = {
+    (genre, authenticity): ", ".join(elements[:3])
+    for genre, by_authenticity in _CULTURAL_ELEMENTS.items()
+    for authenticity, elements in by_authenticity.items()
+}
+
+@functools.lru_cache(maxsize=1024)
 def enhance_prompt_with_culture(prompt: str, genre: str, authenticity: str) -> str:
     """Enhance prompt with Amapiano cultural context"""
-    
-    cultural_elements = {
-        "amapiano": {
-            "traditional": [
-                "deep log drum basslines",
-                "soulful South African piano melodies",
-                "Kwaito-influenced percussion",
-                "gospel-rooted harmonies",
-                "authentic township groove"
-            ],
-            "modern": [
-                "contemporary amapiano production",
-                "electronic log drum synthesis",
-                "modern South African house feel",
-                "urban amapiano style"
-            ],
-            "fusion": [
-                "amapiano with international influences",
-                "cross-cultural rhythmic fusion",
-                "blended traditional and modern elements"
-            ]
-        },
-        "private_school_amapiano": {
-            "traditional": [
-                "jazz-influenced chord progressions",
-                "sophisticated harmonic structure",
-                "live instrument feel",
-                "refined South African musicianship",
-                "subtle percussive textures"
-            ],
-            "modern": [
-                "contemporary private school production",
-                "polished jazz-amapiano fusion",
-                "sophisticated urban sound"
-            ],
-            "fusion": [
-                "private school with global jazz elements",
-                "refined cross-cultural sophistication"
-            ]
-        }
-    }
-    
-    elements = cultural_elements.get(genre, {}).get(authenticity, [])
-    enhancement = ", ".join(elements[:3])
-    
-    enhanced = f"{prompt}. Style: {genre} with {enhancement}. Authentic South African amapiano production at 115 BPM with characteristic log drum and piano elements."
-    
-    return enhanced
+    enhancement = _ENHANCEMENT_BY_KEY.get((genre, authenticity), "")
+    return f"{prompt}. Style: {genre} with {enhancement}. Authentic South African amapiano production at 115 BPM with characteristic log drum and piano elements."
 
 # ===== AUDIO GENERATION ENDPOINT =====
 
@@ -364,18 +952,14 @@ async def generate_music_stream(request: StreamGenerationRequest):
                 if MODELS_AVAILABLE and ai_models.initialized:
                     enhanced_prompt = enhance_prompt_with_culture(request.prompt, request.genre, "traditional")
                     
-                    ai_models.musicgen.set_generation_params(
-                        duration=chunk_duration,
-                        temperature=0.8,
-                        top_k=250
-                    )
-                    
-                    with torch.no_grad():
-                        wav = ai_models.musicgen.generate([enhanced_prompt])
+                    wav = await submit_generation(enhanced_prompt, chunk_duration, 0.8, 250)
                     
                     import io
                     buffer = io.BytesIO()
-                    torchaudio.save(buffer, wav[0].cpu(), sample_rate=ai_models.musicgen.sample_rate, format="wav")
+                    await asyncio.to_thread(
+                        torchaudio.save, buffer, wav,
+                        sample_rate=ai_models.musicgen.sample_rate, format="wav"
+                    )
                     audio_bytes = buffer.getvalue()
                     audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
                 else:
@@ -418,7 +1002,7 @@ async def generate_music(request: MusicGenRequest, background_tasks: BackgroundT
         status=JobStatus.QUEUED,
         created_at=datetime.now()
     )
-    jobs[job_id] = job
+    await jobs.save(job)
     
     # Estimate processing time
     estimated_time = int(request.duration * 2)  # Rough estimate: 2x duration
@@ -441,6 +1025,7 @@ async def process_music_generation(job_id: str, request: MusicGenRequest):
     """Background task for music generation"""
     job = jobs[job_id]
     job.status = JobStatus.PROCESSING
+    await jobs.save(job)
     
     try:
         logger.info(f"[{job_id}] Starting music generation")
@@ -455,28 +1040,33 @@ async def process_music_generation(job_id: str, request: MusicGenRequest):
         logger.info(f"[{job_id}] Enhanced prompt: {enhanced_prompt}")
         
         if MODELS_AVAILABLE and ai_models.initialized:
-            # Real AI generation
-            ai_models.musicgen.set_generation_params(
-                duration=request.duration,
-                temperature=request.temperature,
-                top_k=request.top_k
-            )
-            
             job.progress = 0.3
+            await jobs.save(job)
             
-            # Generate audio
-            with torch.no_grad():
-                wav = ai_models.musicgen.generate([enhanced_prompt])
-            
-            job.progress = 0.8
-            
-            # Save audio
             output_path = OUTPUT_DIR / f"{job_id}.wav"
-            torchaudio.save(
-                str(output_path),
-                wav[0].cpu(),
-                sample_rate=ai_models.musicgen.sample_rate
-            )
+            
+            if request.duration > MUSICGEN_SINGLE_PASS_S:
+                # Beyond a single pass: windowed continuation, playable while generating
+                await generate_in_windows(job, enhanced_prompt, request, output_path)
+            else:
+                # Real AI generation, batched with other queued requests
+                wav = await submit_generation(
+                    enhanced_prompt,
+                    request.duration,
+                    request.temperature,
+                    request.top_k
+                )
+                
+                job.progress = 0.8
+                await jobs.save(job)
+                
+                # Save audio off the event loop
+                await asyncio.to_thread(
+                    torchaudio.save,
+                    str(output_path),
+                    wav,
+                    sample_rate=ai_models.musicgen.sample_rate
+                )
             
         else:
             # Mock generation for demo
@@ -489,6 +1079,7 @@ async def process_music_generation(job_id: str, request: MusicGenRequest):
         job.status = JobStatus.COMPLETED
         job.result_url = f"/download/{job_id}.wav"
         job.completed_at = datetime.now()
+        await jobs.save(job)
         
         logger.info(f"[{job_id}] Generation completed")
         
@@ -496,6 +1087,7 @@ async def process_music_generation(job_id: str, request: MusicGenRequest):
         logger.error(f"[{job_id}] Generation failed: {e}")
         job.status = JobStatus.FAILED
         job.error = str(e)
+        await jobs.save(job)
 
 # ===== STEM SEPARATION ENDPOINT =====
 
@@ -511,11 +1103,14 @@ async def separate_stems(
     """
     job_id = str(uuid.uuid4())
     
-    # Save uploaded file
+    # Stream uploaded file to disk in 1MB chunks, hashing as we go
     upload_path = UPLOAD_DIR / f"{job_id}_{file.filename}"
-    with open(upload_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    hasher = _upload_hasher()
+    async with aiofiles.open(upload_path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            await f.write(chunk)
+    stem_key = stem_cache_key(hasher.hexdigest())
     
     # Create job
     job = Job(
@@ -523,7 +1118,24 @@ async def separate_stems(
         status=JobStatus.QUEUED,
         created_at=datetime.now()
     )
-    jobs[job_id] = job
+    
+    # Identical audio was already separated: reuse its stems
+    stem_paths = cached_stems(stem_key, detect_log_drums)
+    if stem_paths is not None:
+        upload_path.unlink(missing_ok=True)
+        job.status = JobStatus.COMPLETED
+        job.progress = 1.0
+        job.result_url = stem_paths
+        job.completed_at = datetime.now()
+        await jobs.save(job)
+        logger.info(f"[{job_id}] Reusing cached stems {stem_key}")
+        return StemSeparationResponse(
+            job_id=job_id,
+            status=JobStatus.COMPLETED,
+            estimated_time=0
+        )
+    
+    await jobs.save(job)
     
     # Schedule background task
     if background_tasks:
@@ -532,7 +1144,8 @@ async def separate_stems(
             job_id=job_id,
             audio_path=upload_path,
             enhanced=enhanced_processing,
-            detect_log_drums=detect_log_drums
+            detect_log_drums=detect_log_drums,
+            stem_key=stem_key
         )
     
     return StemSeparationResponse(
@@ -541,72 +1154,100 @@ async def separate_stems(
         estimated_time=60  # ~60 seconds for stem separation
     )
 
-async def process_stem_separation(job_id: str, audio_path: Path, enhanced: bool, detect_log_drums: bool = False):
-    """Background task for stem separation with cultural log drum detection"""
+async def process_stem_separation(
+    job_id: str,
+    audio_path: Path,
+    enhanced: bool,
+    detect_log_drums: bool = False,
+    stem_key: Optional[str] = None
+):
+    """
+    Background task for stem separation with cultural log drum detection
+    
+    Stems are stored under stem_key (separator settings plus the upload's
+    content hash) so a repeat upload of the same audio is served from disk
+    without another Demucs pass.
+    """
+    stem_key = stem_key or job_id
     job = jobs[job_id]
     job.status = JobStatus.PROCESSING
+    await jobs.save(job)
     
     try:
         logger.info(f"[{job_id}] Starting stem separation (log_drums={detect_log_drums})")
         
         if MODELS_AVAILABLE and ai_models.initialized:
-            # Load audio
-            wav, sr = torchaudio.load(str(audio_path))
+            # Load audio and upload it on the copy stream
+            wav, sr = await asyncio.to_thread(torchaudio.load, str(audio_path))
+            wav = _to_device_async(wav)
             
-            # Resample if necessary
+            # Resample on the GPU if necessary
             if sr != ai_models.demucs.samplerate:
-                resampler = torchaudio.transforms.Resample(sr, ai_models.demucs.samplerate)
-                wav = resampler(wav)
+                wav = get_resampler(sr, ai_models.demucs.samplerate)(wav)
             
             job.progress = 0.3
+            await jobs.save(job)
+            
+            # Separate stems in a worker thread so the event loop keeps serving
+            # status pushes, streams and the generation batch worker meanwhile
+            # (grad mode is thread-local, so it is set inside the thread)
+            def run_separation() -> torch.Tensor:
+                with torch.no_grad():
+                    return ai_models.separate(wav[None])[0]
             
-            # Separate stems
-            with torch.no_grad():
-                sources = apply_model(ai_models.demucs, wav[None].to(DEVICE))[0]
+            sources = await asyncio.to_thread(run_separation)
             
             job.progress = 0.7
+            await jobs.save(job)
             
-            # Save stems
-            stem_names = ["drums", "bass", "other", "vocals"]
+            # Save stems once their device->host copies land
             stem_paths = {}
             
-            for i, name in enumerate(stem_names):
-                stem_path = STEMS_DIR / f"{job_id}_{name}.wav"
-                torchaudio.save(
-                    str(stem_path),
-                    sources[i].cpu(),
-                    sample_rate=ai_models.demucs.samplerate
+            # One bulk (4, C, N) copy rather than one per stem
+            (host_stems,), copies_done = _to_host_async([sources])
+            if copies_done is not None:
+                await asyncio.to_thread(copies_done.synchronize)
+            
+            await asyncio.gather(*[
+                asyncio.to_thread(
+                    _save_wav_atomic,
+                    STEMS_DIR / f"{stem_key}_{name}.wav",
+                    host_stems[i],
+                    ai_models.demucs.samplerate
                 )
-                stem_paths[name] = f"/download/stems/{job_id}_{name}.wav"
+                for i, name in enumerate(STEM_NAMES)
+            ])
+            for name in STEM_NAMES:
+                stem_paths[name] = _stem_url(stem_key, name)
             
             # Cultural log drum detection
             if detect_log_drums:
                 log_drum_stem = await detect_amapiano_log_drums(sources[0], ai_models.demucs.samplerate)
                 
                 if log_drum_stem is not None:
-                    log_drum_path = STEMS_DIR / f"{job_id}_log_drums.wav"
-                    torchaudio.save(
-                        str(log_drum_path),
+                    log_drum_path = STEMS_DIR / f"{stem_key}_log_drums.wav"
+                    await asyncio.to_thread(
+                        _save_wav_atomic,
+                        log_drum_path,
                         log_drum_stem.cpu(),
-                        sample_rate=ai_models.demucs.samplerate
+                        ai_models.demucs.samplerate
                     )
-                    stem_paths["log_drums"] = f"/download/stems/{job_id}_log_drums.wav"
+                    stem_paths["log_drums"] = _stem_url(stem_key, "log_drums")
                     logger.info(f"[{job_id}] Detected Amapiano log drums")
+                else:
+                    # Lets repeat uploads of this track hit the cache too
+                    await asyncio.to_thread(_no_log_drums_marker(stem_key).touch)
             
         else:
             # Mock separation
             await asyncio.sleep(5)
-            stem_paths = {
-                "drums": f"/download/stems/{job_id}_drums.wav",
-                "bass": f"/download/stems/{job_id}_bass.wav",
-                "vocals": f"/download/stems/{job_id}_vocals.wav",
-                "other": f"/download/stems/{job_id}_other.wav",
-            }
+            stem_paths = {name: _stem_url(stem_key, name) for name in STEM_NAMES}
         
         job.progress = 1.0
         job.status = JobStatus.COMPLETED
         job.result_url = stem_paths
         job.completed_at = datetime.now()
+        await jobs.save(job)
         
         logger.info(f"[{job_id}] Stem separation completed")
         
@@ -614,17 +1255,37 @@ async def process_stem_separation(job_id: str, audio_path: Path, enhanced: bool,
         logger.error(f"[{job_id}] Stem separation failed: {e}")
         job.status = JobStatus.FAILED
         job.error = str(e)
+        await jobs.save(job)
 
 # ===== STATUS AND DOWNLOAD ENDPOINTS =====
 
-@app.get("/status/{job_id}", response_model=JobStatusResponse)
-async def get_job_status(job_id: str):
-    """Get status of a processing job"""
-    job = jobs.get(job_id)
+def audio_file_response(file_path: Path, filename: str, internal_dir: str) -> Response:
+    """
+    Serve a WAV file with range and cache headers
     
-    if not job:
-        raise HTTPException(status_code=404, detail="Job not found")
+    Behind nginx the body is delegated with X-Accel-Redirect to
+    ACCEL_REDIRECT_PREFIX/<internal_dir>/<filename>; otherwise FileResponse
+    serves it and answers Range requests itself.
+    """
+    if ACCEL_REDIRECT_PREFIX:
+        return Response(
+            media_type="audio/wav",
+            headers={
+                **AUDIO_DOWNLOAD_HEADERS,
+                "Content-Disposition": f'attachment; filename="{filename}"',
+                "X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX}/{internal_dir}/{filename}",
+            }
+        )
     
+    return FileResponse(
+        path=file_path,
+        media_type="audio/wav",
+        filename=filename,
+        headers=AUDIO_DOWNLOAD_HEADERS
+    )
+
+def job_status_response(job: Job) -> JobStatusResponse:
+    """Build the public status payload for a job"""
     estimated_remaining = None
     if job.status == JobStatus.PROCESSING and job.progress > 0:
         # Rough estimate based on progress
@@ -640,6 +1301,79 @@ async def get_job_status(job_id: str):
         estimated_remaining=estimated_remaining
     )
 
+@app.get("/status/{job_id}", response_model=JobStatusResponse)
+async def get_job_status(job_id: str):
+    """Get status of a processing job"""
+    job = await jobs.fetch(job_id)
+    
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return job_status_response(job)
+
+STATUS_WS_POLL_S = 5.0  # re-read jobs owned by other replicas, which never signal locally
+
+@app.websocket("/ws/status/{job_id}")
+async def job_status_ws(websocket: WebSocket, job_id: str):
+    """Push job status on every update instead of client polling; closes when the job finishes"""
+    await websocket.accept()
+    if await jobs.fetch(job_id) is None:
+        await websocket.close(code=4404, reason="Job not found")
+        return
+    
+    try:
+        while True:
+            # Take the event before reading so an update in between isn't missed
+            updated = jobs.update_event(job_id)
+            job = await jobs.fetch(job_id)
+            if job is None:
+                break
+            
+            await websocket.send_text(job_status_response(job).model_dump_json())
+            if job.status in (JobStatus.COMPLETED, JobStatus.FAILED):
+                break
+            
+            try:
+                await asyncio.wait_for(updated.wait(), timeout=STATUS_WS_POLL_S)
+            except asyncio.TimeoutError:
+                pass
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        jobs.release_event(job_id)
+
+@app.get("/stream/{job_id}.wav")
+async def stream_generation(job_id: str):
+    """Progressively stream a windowed generation as it is produced"""
+    stream = _live_streams.get(job_id)
+    if stream is None:
+        output_path = OUTPUT_DIR / f"{job_id}.wav"
+        if not output_path.exists():
+            raise HTTPException(status_code=404, detail="Stream not found")
+        # Already finished (or never windowed): serve the complete file
+        return audio_file_response(output_path, output_path.name, "outputs")
+    
+    async def body():
+        yield _streaming_wav_header(stream.sample_rate, stream.channels)
+        sent = 0
+        async with aiofiles.open(stream.path, "rb") as f:
+            await f.seek(WAV_HEADER_BYTES)
+            while True:
+                updated = stream.updated
+                available = stream.bytes_written - sent
+                if available > 0:
+                    data = await f.read(available)
+                    if data:
+                        sent += len(data)
+                        yield data
+                        continue
+                if stream.done:
+                    break
+                await updated.wait()
+    
+    return StreamingResponse(body(), media_type="audio/wav", headers={"Cache-Control": "no-cache"})
+
 @app.get("/download/{filename}")
 async def download_file(filename: str):
     """Download generated audio file"""
@@ -648,11 +1382,7 @@ async def download_file(filename: str):
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="File not found")
     
-    return FileResponse(
-        path=file_path,
-        media_type="audio/wav",
-        filename=filename
-    )
+    return audio_file_response(file_path, filename, "outputs")
 
 @app.get("/download/stems/{filename}")
 async def download_stem(filename: str):
@@ -662,11 +1392,7 @@ async def download_stem(filename: str):
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="Stem file not found")
     
-    return FileResponse(
-        path=file_path,
-        media_type="audio/wav",
-        filename=filename
-    )
+    return audio_file_response(file_path, filename, "stems")
 
 # ===== HEALTH AND INFO ENDPOINTS =====
 
@@ -691,6 +1417,8 @@ async def root():
             "generate": "/generate",
             "separate_stems": "/separate-stems",
             "status": "/status/{job_id}",
+            "status_ws": "/ws/status/{job_id}",
+            "stream": "/stream/{job_id}.wav",
             "health": "/health"
         },
         "gpu_available": torch.cuda.is_available(),
@@ -707,6 +1435,10 @@ async def startup_event():
         await ai_models.initialize()
     except Exception as e:
         logger.error(f"Failed to initialize: {e}")
+    
+    global _gen_queue
+    _gen_queue = asyncio.Queue()
+    app.state.generation_worker = asyncio.create_task(generation_batch_worker())
 
 @app.on_event("shutdown")
 async def shutdown_event():
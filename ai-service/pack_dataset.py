@@ -0,0 +1,105 @@
+"""
+Audio Packing for the Amapiano Proxy Dataset
+Decodes every clip once into a single memory-mapped float16 file so loaders skip per-file decoding
+"""
+
+import numpy as np
+import torch
+import torchaudio
+from pathlib import Path
+import logging
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from train_musicgen import (
+    DATASET_DIR,
+    existing_audio_files,
+    load_training_metadata,
+    PACK_BIN,
+    PACK_INDEX,
+    PACK_META,
+    pack_fingerprint,
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 32000  # MusicGen / EnCodec rate
+
+
+@functools.lru_cache(maxsize=None)
+def _get_resampler(src: int, dst: int) -> torchaudio.transforms.Resample:
+    return torchaudio.transforms.Resample(src, dst)
+
+
+def _decode_mono(path: Path, sample_rate: int) -> np.ndarray:
+    """Decode one clip to mono float16 at sample_rate; empty if it is missing or unreadable"""
+    if path is None:
+        return np.empty(0, dtype=np.float16)
+    try:
+        wav, sr = torchaudio.load(str(path))
+    except Exception as e:
+        logger.warning(f"Could not decode {path}: {e}")
+        return np.empty(0, dtype=np.float16)
+    if sr != sample_rate:
+        wav = _get_resampler(sr, sample_rate)(wav)
+    return wav.mean(dim=0).to(torch.float16).numpy()
+
+
+def pack_dataset(metadata_path: Path = DATASET_DIR / "training_metadata.csv",
+                 sample_rate: int = SAMPLE_RATE) -> Path:
+    """
+    Write clips.bin plus clips.idx.npy for every row of the training metadata
+
+    clips.bin holds all clips back to back as mono float16 samples.
+    clips.idx.npy has one (start_sample, n_samples) row per metadata row, in
+    metadata order; rows whose file is missing or unreadable get n_samples=0.
+    clips.json records the sample rate, row count and a hash of the ordered
+    file_path column so loaders can check the pack still matches the metadata.
+    """
+    metadata = load_training_metadata(metadata_path)
+    existing = existing_audio_files(DATASET_DIR)
+    paths = [DATASET_DIR / p if p in existing else None for p in metadata['file_path']]
+    spans = np.zeros((len(paths), 2), dtype=np.int64)
+
+    tmp_bin = PACK_BIN.with_name(PACK_BIN.name + ".tmp")
+    offset = 0
+    with open(tmp_bin, 'wb') as f, ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+        # map() keeps input order, so clips are appended in metadata order
+        for i, samples in enumerate(executor.map(lambda p: _decode_mono(p, sample_rate), paths)):
+            f.write(samples.tobytes())
+            spans[i] = (offset, len(samples))
+            offset += len(samples)
+
+            if (i + 1) % 500 == 0:
+                logger.info(f"Packed {i + 1}/{len(paths)} clips")
+
+    os.replace(tmp_bin, PACK_BIN)
+    np.save(PACK_INDEX, spans)
+    with open(PACK_META, 'w') as f:
+        json.dump({
+            'sample_rate': sample_rate,
+            'num_rows': len(paths),
+            'file_paths_sha256': pack_fingerprint(metadata['file_path']),
+        }, f, indent=2)
+
+    packed = int((spans[:, 1] > 0).sum())
+    logger.info(f"✓ Packed {packed}/{len(paths)} clips ({offset * 2 / 1e9:.2f} GB) into {PACK_BIN}")
+    return PACK_BIN
+
+
+def main():
+    """Main execution flow"""
+    logger.info("Amapiano Proxy Audio Packing")
+    logger.info("="*60)
+
+    pack_dataset()
+
+
+if __name__ == "__main__":
+    main()
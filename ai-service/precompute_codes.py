@@ -0,0 +1,111 @@
+"""
+EnCodec Token Precomputation for MusicGen Fine-Tuning
+Encodes every Amapiano proxy clip once so training reads tokens instead of audio
+"""
+
+import torch
+import pandas as pd
+from audiocraft.models import MusicGen
+from torch.utils.data import DataLoader, Subset
+from pathlib import Path
+import logging
+import math
+
+from train_musicgen import (
+    AmapianoProxyDataset,
+    BucketSampler,
+    CODES_DIR,
+    CODES_INDEX,
+    DATASET_DIR,
+    DEVICE,
+    mixdown_on_device,
+    pick_num_workers,
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'facebook/musicgen-small'
+ENCODE_BATCH_SIZE = 16
+
+
+def precompute_codes(model_name: str = MODEL_NAME) -> Path:
+    """
+    Encode each clip with the MusicGen compression model and save its codes
+
+    Clips are encoded in padded batches, then each clip's codes are trimmed
+    to its own length and stored as a (K, T) int16 tensor - one .pt file per
+    clip - indexed in codes_index.csv. Clips that already have a code file
+    are skipped, so an interrupted run can simply be restarted.
+    """
+    logger.info(f"Loading {model_name} compression model...")
+    model = MusicGen.get_pretrained(model_name, device=DEVICE)
+    model.compression_model.eval()
+
+    dataset = AmapianoProxyDataset(
+        metadata_path=DATASET_DIR / "training_metadata.csv",
+        audio_dir=DATASET_DIR,
+        sample_rate=model.sample_rate
+    )
+
+    CODES_DIR.mkdir(exist_ok=True, parents=True)
+
+    codes_paths = [CODES_DIR / f"{clip_id}.pt" for clip_id in dataset.clip_ids]
+    todo = [idx for idx, path in enumerate(codes_paths) if not path.exists()]
+    logger.info(f"{len(todo)} of {len(dataset)} clips need encoding")
+
+    # Similar-length clips per batch keep padding (and wasted encoder work) small
+    batches = list(BucketSampler(dataset.durations[todo], ENCODE_BATCH_SIZE, shuffle=False))
+    loader = DataLoader(
+        Subset(dataset, todo),
+        batch_sampler=batches,
+        num_workers=pick_num_workers(),
+        collate_fn=dataset.collate_fn,
+        pin_memory=DEVICE == "cuda"
+    )
+    frames_per_sample = model.compression_model.frame_rate / model.sample_rate
+
+    encoded = 0
+    for positions, (wavs, lengths, channels, _) in zip(batches, loader):
+        with torch.inference_mode():
+            codes, _ = model.compression_model.encode(mixdown_on_device(wavs, channels))
+        codes = codes.cpu().to(torch.int16)
+
+        for j, position in enumerate(positions):
+            num_frames = math.ceil(int(lengths[j]) * frames_per_sample)
+            torch.save(codes[j, :, :num_frames].clone(), codes_paths[todo[position]])
+
+        encoded += len(positions)
+        if encoded % 500 < len(positions):
+            logger.info(f"Encoded {encoded}/{len(todo)} clips")
+
+    rows = []
+    for idx, codes_path in enumerate(codes_paths):
+        codes = torch.load(codes_path, mmap=True)
+        rows.append({
+            'clip_id': dataset.clip_ids[idx],
+            'codes_path': codes_path.name,
+            'num_frames': codes.shape[-1],
+            'tags': ','.join(dataset.tags[idx]),
+        })
+
+    pd.DataFrame(rows).to_csv(CODES_INDEX, index=False)
+
+    logger.info(f"✓ Encoded {encoded} new clips, {len(rows)} total")
+    logger.info(f"✓ Index saved to {CODES_INDEX}")
+    return CODES_INDEX
+
+
+def main():
+    """Main execution flow"""
+    logger.info("EnCodec Token Precomputation")
+    logger.info("="*60)
+
+    precompute_codes()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,14 +7,26 @@ import torch
 import torchaudio
 from audiocraft.models import MusicGen
 from audiocraft.modules.conditioners import ConditioningAttributes
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import logging
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 import json
-from datetime import datetime
+import atexit
+import functools
+import hashlib
 import os
+import queue
+import threading
+import time
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,18 +35,39 @@ DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 DATASET_DIR = Path("./datasets/amapiano_proxy")
 CHECKPOINT_DIR = Path("./checkpoints/phase_2_5")
 LOGS_DIR = Path("./training_logs")
+CODES_DIR = DATASET_DIR / "codes"
+CODES_INDEX = CODES_DIR / "codes_index.csv"
+PACK_BIN = DATASET_DIR / "clips.bin"
+PACK_INDEX = DATASET_DIR / "clips.idx.npy"
+PACK_META = DATASET_DIR / "clips.json"
 LAST_CHECKPOINT = CHECKPOINT_DIR / "last.ckpt"
 BEST_CHECKPOINT = CHECKPOINT_DIR / "best_model.pt"
 
+
+def _pick_amp_dtype() -> torch.dtype:
+    """bf16 autocast on Ampere+ (sm_80), which needs no loss scaling; fp16 + GradScaler on older GPUs such as the T4"""
+    if DEVICE == "cuda" and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+AMP_DTYPE = _pick_amp_dtype()
+
+
 CHECKPOINT_DIR.mkdir(exist_ok=True, parents=True)
 LOGS_DIR.mkdir(exist_ok=True)
 
-BATCH_SIZE = 8
+BATCH_SIZE = 16
 LEARNING_RATE = 1e-5
 NUM_EPOCHS = 20
-GRADIENT_ACCUMULATION_STEPS = 4
+GRADIENT_ACCUMULATION_STEPS = 2
+# Recompute transformer activations in backward; what lets BATCH_SIZE=16 fit (set by the orchestrator)
+USE_GRAD_CHECKPOINTING = os.getenv("AMAPIANO_GRAD_CHECKPOINTING", "1") == "1"
+# Cache frozen T5 prompt encodings instead of re-running the text encoder every step
+CACHE_TEXT_CONDITIONING = os.getenv("AMAPIANO_CACHE_CONDITIONING", "1") == "1"
 WARMUP_STEPS = 500
 SAVE_EVERY_N_EPOCHS = 2
+NUM_DURATION_BUCKETS = 8
+PAD_CODE = -100  # padded code positions; matches cross_entropy's default ignore_index
 
 AMAPIANO_STYLE_PROMPTS = [
     "South African amapiano with deep log drums and soulful piano",
@@ -45,102 +78,431 @@ AMAPIANO_STYLE_PROMPTS = [
     "Deep house amapiano fusion with African rhythms",
 ]
 
+_AMAPIANO_TAGSET = frozenset({'drums', 'piano', 'bass', 'house', 'electronic', 'jazzy', 'deep'})
+
+
+def _dumps_line(obj) -> bytes:
+    """One compact JSON line as bytes; orjson when installed"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj) + b"\n"
+    return (json.dumps(obj) + "\n").encode()
+
+
+def split_tags(tags) -> Tuple[str, ...]:
+    """Split a comma-separated tag column value; empty cells come back from pandas as NaN"""
+    return tuple(tags.split(',')) if isinstance(tags, str) else ()
+
+
+def load_training_metadata(metadata_path: Path) -> pd.DataFrame:
+    """
+    Training metadata written by dataset_setup.py, with tags as lists
+    
+    Reads the Parquet copy next to metadata_path when there is one, so tags
+    are never re-split; CSV-only metadata from older runs is split here.
+    """
+    parquet_path = metadata_path.with_suffix('.parquet')
+    if parquet_path.exists():
+        return pd.read_parquet(parquet_path)
+    
+    df = pd.read_csv(metadata_path)
+    df['tags'] = df['tags'].map(split_tags)
+    return df
+
+
+def existing_audio_files(audio_dir: Path) -> set:
+    """Paths (relative to audio_dir, POSIX style) of every file below it, from one directory walk"""
+    existing = set()
+    for root, _, files in os.walk(audio_dir):
+        rel_root = Path(root).relative_to(audio_dir)
+        existing.update((rel_root / name).as_posix() for name in files)
+    return existing
+
+
+def pack_fingerprint(file_paths) -> str:
+    """Hash of the ordered metadata file_path column, stored in clips.json to tie a pack to its metadata"""
+    return hashlib.sha256('\n'.join(file_paths).encode('utf-8')).hexdigest()
+
+
+def build_prompt(tags: Tuple[str, ...], idx: int) -> str:
+    """
+    Amapiano style prompt for sample idx, extended with up to 3 matching clip tags
+    
+    The base prompt is picked by index rather than at random, so every
+    DataLoader worker (and every run) pairs a clip with the same prompt.
+    """
+    amapiano_tags = [tag for tag in tags if tag in _AMAPIANO_TAGSET]
+    
+    base_prompt = AMAPIANO_STYLE_PROMPTS[idx % len(AMAPIANO_STYLE_PROMPTS)]
+    if amapiano_tags:
+        tag_desc = ', '.join(amapiano_tags[:3])
+        return f"{base_prompt}. Elements: {tag_desc}"
+    return base_prompt
+
 
 class AmapianoProxyDataset(Dataset):
-    """Dataset for MusicGen fine-tuning on Amapiano proxy clips"""
+    """
+    Dataset for MusicGen fine-tuning on Amapiano proxy clips
+    
+    When pack_dataset.py has written a matching clips.bin, clips are sliced
+    out of that memory map instead of being decoded file by file.
+    """
     
     def __init__(self, metadata_path: Path, audio_dir: Path, sample_rate: int = 32000):
-        self.metadata = pd.read_csv(metadata_path)
+        metadata = load_training_metadata(metadata_path)
         self.audio_dir = audio_dir
         self.sample_rate = sample_rate
+        # One Resample (and its sinc kernel) per source rate; each worker keeps its own
+        self._resamplers: dict[int, torchaudio.transforms.Resample] = {}
+        # Opened lazily so each DataLoader worker maps the file instead of unpickling a copy
+        self._mm = None
+        self._spans = self._load_pack_index(audio_dir, metadata['file_path'], sample_rate)
         
-        self.metadata = self.metadata[
-            self.metadata['file_path'].apply(
-                lambda x: (audio_dir / x).exists()
-            )
-        ]
+        if self._spans is not None:
+            keep = self._spans[:, 1] > 0
+            metadata = metadata[keep]
+            self._spans = self._spans[keep]
+        else:
+            # One walk of the tree instead of a stat() per row
+            metadata = metadata[metadata['file_path'].isin(existing_audio_files(audio_dir))]
         
-        logger.info(f"Loaded dataset with {len(self.metadata)} valid clips")
+        # Struct-of-arrays instead of the DataFrame: __getitem__ indexes plain
+        # arrays rather than building a pandas Series per sample
+        self.clip_ids = metadata['clip_id'].to_numpy()
+        self.tags = [tuple(t) for t in metadata['tags']]
+        self._paths = metadata['file_path'].to_numpy()
+        fallback = metadata['duration'].to_numpy(dtype=np.float32) if 'duration' in metadata else None
+        
+        if self._spans is not None:
+            self.durations = (self._spans[:, 1] / sample_rate).astype(np.float32)
+        else:
+            self.durations = self._probe_durations(fallback)
+        
+        source = "packed clips.bin" if self._spans is not None else "audio files"
+        logger.info(f"Loaded dataset with {len(self._paths)} valid clips from {source}")
     
     def __len__(self):
-        return len(self.metadata)
+        return len(self._paths)
+    
+    def __getstate__(self):
+        # Never pickle the memory map itself (that would copy the whole pack into each worker)
+        state = self.__dict__.copy()
+        state['_mm'] = None
+        return state
+    
+    @staticmethod
+    def _load_pack_index(audio_dir: Path, file_paths: pd.Series, sample_rate: int):
+        """
+        (start_sample, n_samples) per metadata row, or None if there is no matching pack
+        
+        A pack only matches when it was written from the same file_path
+        list in the same order, so a pack left over from an earlier filter
+        run (same row count, different clips) is never used.
+        """
+        pack_meta = audio_dir / PACK_META.name
+        if not pack_meta.exists():
+            return None
+        with open(pack_meta) as f:
+            meta = json.load(f)
+        if meta['sample_rate'] != sample_rate or meta['num_rows'] != len(file_paths):
+            logger.warning(f"Ignoring {pack_meta}: packed for a different sample rate or metadata")
+            return None
+        if meta.get('file_paths_sha256') != pack_fingerprint(file_paths):
+            logger.warning(f"Ignoring {pack_meta}: packed from different clips; re-run pack_dataset.py")
+            return None
+        return np.load(audio_dir / PACK_INDEX.name)
+    
+    def _probe_durations(self, fallback: np.ndarray = None) -> np.ndarray:
+        """Clip durations in seconds from file headers, falling back to the metadata column"""
+        durations = np.empty(len(self._paths), dtype=np.float32)
+        for i, file_path in enumerate(self._paths):
+            try:
+                info = torchaudio.info(str(self.audio_dir / file_path))
+                durations[i] = info.num_frames / info.sample_rate
+            except Exception:
+                durations[i] = 0.0
+            if durations[i] <= 0 and fallback is not None:
+                durations[i] = fallback[i]
+        return durations
+    
+    def _get_resampler(self, sr: int) -> torchaudio.transforms.Resample:
+        resampler = self._resamplers.get(sr)
+        if resampler is None:
+            resampler = torchaudio.transforms.Resample(sr, self.sample_rate)
+            self._resamplers[sr] = resampler
+        return resampler
     
     def __getitem__(self, idx) -> Tuple[torch.Tensor, str]:
-        row = self.metadata.iloc[idx]
+        """Decoded, resampled clip with all of its channels; mixdown happens on the GPU"""
+        if self._spans is not None:
+            if self._mm is None:
+                self._mm = np.memmap(self.audio_dir / PACK_BIN.name, dtype=np.float16, mode='r')
+            start, n = self._spans[idx]
+            wav = torch.from_numpy(self._mm[start:start + n].astype(np.float32, copy=True)).unsqueeze(0)
+            return wav, build_prompt(self.tags[idx], idx)
         
-        audio_path = self.audio_dir.parent / row['file_path']
+        audio_path = self.audio_dir / self._paths[idx]
         wav, sr = torchaudio.load(str(audio_path))
         
         if sr != self.sample_rate:
-            resampler = torchaudio.transforms.Resample(sr, self.sample_rate)
-            wav = resampler(wav)
+            wav = self._get_resampler(sr)(wav)
         
-        if wav.shape[0] > 1:
-            wav = wav.mean(dim=0, keepdim=True)
+        return wav, build_prompt(self.tags[idx], idx)
+    
+    def collate_fn(self, batch: List[Tuple[torch.Tensor, str]]):
+        """
+        Batch raw (C, T) clips as a nested tensor plus their lengths and channel counts
         
-        tags = row['tags'].split(',')
-        amapiano_tags = [tag for tag in tags if tag in {
-            'drums', 'piano', 'bass', 'house', 'electronic', 'jazzy', 'deep'
-        }]
+        No padding or mixdown in the worker - mixdown_on_device() does both
+        in one vectorized pass after the host-to-device copy.
+        """
+        wavs, prompts = zip(*batch)
+        lengths = torch.tensor([wav.shape[-1] for wav in wavs])
+        channels = torch.tensor([wav.shape[0] for wav in wavs])
         
-        import random
-        base_prompt = random.choice(AMAPIANO_STYLE_PROMPTS)
-        if amapiano_tags:
-            tag_desc = ', '.join(amapiano_tags[:3])
-            prompt = f"{base_prompt}. Elements: {tag_desc}"
-        else:
-            prompt = base_prompt
+        return torch.nested.nested_tensor(list(wavs)), lengths, channels, list(prompts)
+
+
+def mixdown_on_device(wavs: torch.Tensor, channels: torch.Tensor) -> torch.Tensor:
+    """Pad a nested batch of (C, T) clips and average each to mono, as (B, 1, T) on DEVICE"""
+    wavs = wavs.to(DEVICE, non_blocking=True).to_padded_tensor(0.0)
+    channels = channels.to(DEVICE, non_blocking=True).to(wavs.dtype)
+    # Zero-padded channels add nothing to the sum, so divide by each clip's own channel count
+    return wavs.sum(dim=1, keepdim=True) / channels.view(-1, 1, 1)
+
+
+class CodesDataset(Dataset):
+    """
+    Dataset of precomputed EnCodec tokens (see precompute_codes.py)
+    
+    Each item is a (K, T) int16 code tensor, memory-mapped from disk, plus a
+    prompt, so neither resampling nor the compression model runs per step.
+    """
+    
+    def __init__(self, index_path: Path, frame_rate: float):
+        index = pd.read_csv(index_path)
+        self.codes_dir = index_path.parent
+        self.durations = (index['num_frames'] / frame_rate).to_numpy(dtype=np.float32)
+        self.tags = [split_tags(t) for t in index['tags']]
+        self._paths = index['codes_path'].to_numpy()
         
-        return wav, prompt
+        logger.info(f"Loaded {len(self._paths)} precomputed code sequences")
+    
+    def __len__(self):
+        return len(self._paths)
+    
+    def __getitem__(self, idx) -> Tuple[torch.Tensor, str]:
+        codes = torch.load(self.codes_dir / self._paths[idx], mmap=True)
+        return codes, build_prompt(self.tags[idx], idx)
     
     def collate_fn(self, batch: List[Tuple[torch.Tensor, str]]):
-        """Collate function to pad audio tensors to same length"""
-        wavs, prompts = zip(*batch)
+        """Pad code sequences with PAD_CODE so padding is excluded from the loss"""
+        codes, prompts = zip(*batch)
         
-        max_length = max(wav.shape[-1] for wav in wavs)
+        max_length = max(c.shape[-1] for c in codes)
+        codes_tensor = torch.full((len(codes), codes[0].shape[0], max_length), PAD_CODE, dtype=torch.int16)
+        for i, c in enumerate(codes):
+            codes_tensor[i, :, :c.shape[-1]] = c
         
-        padded_wavs = []
-        for wav in wavs:
-            if wav.shape[-1] < max_length:
-                padding = max_length - wav.shape[-1]
-                wav = torch.nn.functional.pad(wav, (0, padding))
-            padded_wavs.append(wav)
+        return codes_tensor, list(prompts)
+
+
+class BucketSampler(Sampler[List[int]]):
+    """
+    Batch sampler that groups clips of similar duration
+    
+    Indices are sorted by duration and split into quantile buckets; every
+    batch comes from a single bucket, so collate_fn pads to a near-identical
+    length. Buckets of shorter clips get proportionally larger batches, so
+    each batch holds about as much audio as a batch of the longest clips.
+    """
+    
+    def __init__(self, durations: np.ndarray, batch_size: int, num_buckets: int = NUM_DURATION_BUCKETS,
+                 shuffle: bool = True, seed: int = 0):
+        order = np.argsort(durations, kind='stable')
+        self.buckets = [b for b in np.array_split(order, num_buckets) if len(b)]
+        longest = float(durations.max()) if len(durations) else 1.0
+        # Capped so per-step overhead (conditioning, optimizer) stays comparable
+        self.batch_sizes = [
+            min(batch_size * 4, max(1, int(batch_size * longest / max(float(durations[b[-1]]), 1e-3))))
+            for b in self.buckets
+        ]
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+    
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+    
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for bucket, bs in zip(self.buckets, self.batch_sizes):
+            indices = rng.permutation(bucket) if self.shuffle else bucket
+            batches.extend(indices[i:i + bs].tolist() for i in range(0, len(indices), bs))
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+    
+    def __len__(self) -> int:
+        return sum(-(-len(b) // bs) for b, bs in zip(self.buckets, self.batch_sizes))
+
+
+def pick_num_workers() -> int:
+    """DataLoader worker count; AMAPIANO_NUM_WORKERS overrides the cpu_count heuristic"""
+    override = os.getenv("AMAPIANO_NUM_WORKERS")
+    if override is not None:
+        return max(0, int(override))
+    return min(os.cpu_count() or 2, 8) if DEVICE == "cuda" else 0
+
+
+class PromptConditioner:
+    """
+    Text conditioning for training batches with cached T5 encodings
+    
+    MusicGen's T5 encoder is frozen, so its output for a given prompt never
+    changes; only the output projection after it is trained. T5 hidden states
+    are cached per prompt string and the projection runs per batch, which
+    keeps its gradients while taking the text encoder out of the hot path.
+    Classifier-free guidance dropout is applied the way audiocraft does it:
+    a dropped sample gets an all-zero mask and therefore zero conditioning.
+    """
+    
+    def __init__(self, lm, maxsize: int = 4096):
+        self.lm = lm
+        self.conditioner = lm.condition_provider.conditioners['description']
+        self.cfg_dropout_p = lm.cfg_dropout.p
+        self._encode = functools.lru_cache(maxsize=maxsize)(self._encode_prompt)
+    
+    @torch.no_grad()
+    def _encode_prompt(self, prompt: str) -> torch.Tensor:
+        inputs = self.conditioner.tokenize([prompt])
+        return self.conditioner.t5(**inputs).last_hidden_state[0].float()
+    
+    def __call__(self, prompts: List[str]) -> dict:
+        encodings = [self._encode(prompt) for prompt in prompts]
+        hidden = torch.nn.utils.rnn.pad_sequence(encodings, batch_first=True)
+        mask = torch.nn.utils.rnn.pad_sequence(
+            [torch.ones(len(e), dtype=torch.long, device=e.device) for e in encodings],
+            batch_first=True
+        )
         
-        wavs_tensor = torch.stack(padded_wavs)
+        if self.lm.training and self.cfg_dropout_p > 0:
+            keep = torch.rand(len(prompts), 1, device=mask.device) >= self.cfg_dropout_p
+            mask = mask * keep
         
-        return wavs_tensor, list(prompts)
+        proj = self.conditioner.output_proj
+        embeds = proj(hidden.to(proj.weight)) * mask.unsqueeze(-1)
+        return {'description': (embeds, mask)}
+
+
+def _worker_init_fn(worker_id: int, num_threads: int = 1):
+    """Budget intra-op threads per DataLoader worker so workers don't oversubscribe the CPU"""
+    torch.set_num_threads(num_threads)
+
+
+def _cpu_snapshot(obj):
+    """Deep copy of a (nested) state dict with every tensor moved to CPU"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _cpu_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class _CheckpointWriter:
+    """
+    Background thread that writes checkpoints off the training loop
+    
+    Payloads are CPU snapshots, so training can keep mutating the live
+    parameters. Each file is written to a temp path and os.replace()d into
+    place, so a crash or Spot interruption mid-write never leaves a truncated
+    last.ckpt behind. Pending writes are flushed at interpreter exit.
+    """
+    
+    def __init__(self, max_pending: int = 4):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def submit(self, payload: dict, path: Path):
+        self._queue.put((payload, path))
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            payload, path = item
+            tmp_path = path.with_name(path.name + ".tmp")
+            try:
+                torch.save(payload, tmp_path, _use_new_zipfile_serialization=True, pickle_protocol=5)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.error(f"Failed to write checkpoint {path}: {e}")
+    
+    def close(self):
+        """Wait for queued checkpoints to finish writing"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
 
 
 class TrainingMetrics:
-    """Track and log training metrics"""
+    """
+    Track and log training metrics
+    
+    log() only writes into a preallocated NumPy structured buffer; rows are
+    appended to training_metrics.jsonl a buffer at a time (and on save()), so
+    the per-batch cost is one array store and IO stays off the hot path.
+    Resumed runs keep appending to the same file.
+    """
+    
+    _DTYPE = np.dtype([
+        ('epoch', 'i4'),
+        ('batch', 'i4'),
+        ('loss', 'f8'),
+        ('learning_rate', 'f8'),
+        ('timestamp', 'f8'),
+    ])
     
-    def __init__(self, log_dir: Path):
+    def __init__(self, log_dir: Path, buffer_size: int = 4096):
         self.log_dir = log_dir
-        self.metrics = {
-            'epoch': [],
-            'batch': [],
-            'loss': [],
-            'learning_rate': [],
-            'timestamp': []
-        }
+        self.metrics_path = log_dir / "training_metrics.jsonl"
+        self._f = open(self.metrics_path, 'ab')
+        self._buf = np.empty(buffer_size, dtype=self._DTYPE)
+        self._i = 0
     
     def log(self, epoch: int, batch: int, loss: float, lr: float):
-        self.metrics['epoch'].append(epoch)
-        self.metrics['batch'].append(batch)
-        self.metrics['loss'].append(loss)
-        self.metrics['learning_rate'].append(lr)
-        self.metrics['timestamp'].append(datetime.now().isoformat())
+        self._buf[self._i] = (epoch, batch, loss, lr, time.time())
+        self._i += 1
+        if self._i == len(self._buf):
+            self.save()
     
     def save(self):
-        metrics_path = self.log_dir / "training_metrics.json"
-        with open(metrics_path, 'w') as f:
-            json.dump(self.metrics, f, indent=2)
-        
-        df = pd.DataFrame(self.metrics)
+        """Append buffered rows to the JSONL log"""
+        names = self._DTYPE.names
+        self._f.write(b''.join(
+            _dumps_line(dict(zip(names, row)))
+            for row in self._buf[:self._i].tolist()
+        ))
+        self._f.flush()
+        self._i = 0
+    
+    def load(self) -> pd.DataFrame:
+        """Read the logged rows back for analysis (timestamps are Unix seconds)"""
+        self.save()
+        return pd.read_json(self.metrics_path, lines=True, convert_dates=False)
+    
+    def close(self):
+        """Flush the log and export it once as training_metrics.csv"""
+        self.save()
         csv_path = self.log_dir / "training_metrics.csv"
-        df.to_csv(csv_path, index=False)
-        
-        logger.info(f"Saved metrics to {metrics_path}")
+        self.load().to_csv(csv_path, index=False)
+        self._f.close()
+        logger.info(f"Saved metrics to {self.metrics_path} and {csv_path}")
 
 
 def train_musicgen():
@@ -157,25 +519,55 @@ def train_musicgen():
     
     logger.info("\nLoading MusicGen model...")
     model = MusicGen.get_pretrained('facebook/musicgen-small', device=DEVICE)
-    sample_rate = model.sample_rate
+    # get_pretrained loads the LM in fp16 on CUDA; keep fp32 master weights and let autocast downcast
+    model.lm.float()
+    logger.info(f"Mixed precision: {AMP_DTYPE}")
+    
+    if USE_GRAD_CHECKPOINTING:
+        # StreamingTransformer wraps each layer in torch.utils.checkpoint (use_reentrant=False)
+        model.lm.transformer.checkpointing = 'torch'
+        logger.info("Gradient checkpointing enabled on LM transformer layers")
+    
+    if hasattr(torch, "compile") and DEVICE == "cuda":
+        # compute_predictions() calls the module's forward, so compile that rather
+        # than replacing model.lm (keeps state_dict keys unchanged). Bucketed batches
+        # give only a handful of sequence lengths; dynamic shapes cover the rest.
+        logger.info("Compiling LM forward with torch.compile (first steps will take 20-50s longer)...")
+        model.lm.forward = torch.compile(model.lm.forward, fullgraph=False, dynamic=True)
     
     logger.info("\nLoading dataset...")
-    metadata_path = DATASET_DIR / "training_metadata.csv"
-    dataset = AmapianoProxyDataset(
-        metadata_path=metadata_path,
-        audio_dir=DATASET_DIR,
-        sample_rate=sample_rate
-    )
+    if not CODES_INDEX.exists():
+        raise FileNotFoundError(
+            f"{CODES_INDEX} not found - run precompute_codes.py to encode the dataset first"
+        )
+    dataset = CodesDataset(CODES_INDEX, model.compression_model.frame_rate)
+    
+    num_workers = pick_num_workers()
+    logger.info(f"DataLoader workers: {num_workers}")
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(
+            persistent_workers=True,
+            prefetch_factor=4,
+            worker_init_fn=functools.partial(
+                _worker_init_fn,
+                num_threads=max(1, (os.cpu_count() or 1) // num_workers)
+            )
+        )
     
+    batch_sampler = BucketSampler(dataset.durations, BATCH_SIZE)
     dataloader = DataLoader(
         dataset,
-        batch_size=BATCH_SIZE,
-        shuffle=True,
-        num_workers=4,
+        batch_sampler=batch_sampler,
+        num_workers=num_workers,
         collate_fn=dataset.collate_fn,
-        pin_memory=True
+        pin_memory=True,
+        pin_memory_device=DEVICE if DEVICE == "cuda" else "",
+        **worker_kwargs
     )
     
+    prompt_conditioner = PromptConditioner(model.lm) if CACHE_TEXT_CONDITIONING else None
+    
     logger.info("\nSetting up optimizer...")
     optimizer = torch.optim.AdamW(
         model.lm.parameters(),
@@ -191,7 +583,11 @@ def train_musicgen():
         eta_min=1e-7
     )
     
+    # Only fp16 needs loss scaling; with bf16 the scaler is a pass-through
+    scaler = torch.cuda.amp.GradScaler(enabled=DEVICE == "cuda" and AMP_DTYPE == torch.float16)
+    
     metrics = TrainingMetrics(LOGS_DIR)
+    checkpoint_writer = _CheckpointWriter()
     
     # Check for existing checkpoint (Spot instance resume)
     start_epoch = 0
@@ -204,6 +600,8 @@ def train_musicgen():
         model.lm.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        if 'scaler_state_dict' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
         start_epoch = checkpoint['epoch'] + 1
         global_step = checkpoint['global_step']
         best_loss = checkpoint.get('best_loss', float('inf'))
@@ -217,39 +615,54 @@ def train_musicgen():
     
     for epoch in range(start_epoch, NUM_EPOCHS):
         model.lm.train()
+        batch_sampler.set_epoch(epoch)
         epoch_loss = 0.0
         
-        for batch_idx, (wavs, prompts) in enumerate(dataloader):
-            wavs = wavs.to(DEVICE)
+        for batch_idx, (codes, prompts) in enumerate(dataloader):
+            # Pinned batch: the copy is queued on the stream and overlaps with host-side conditioning
+            codes = codes.to(DEVICE, non_blocking=True).long()
             
             try:
-                with torch.cuda.amp.autocast():
-                    attributes = [
+                # Outside autocast so cached fp32 encodings are used as-is
+                if prompt_conditioner is not None:
+                    conditions, condition_tensors = [], prompt_conditioner(prompts)
+                else:
+                    conditions = [
                         ConditioningAttributes(text={'description': prompt})
                         for prompt in prompts
                     ]
+                    condition_tensors = None
+                
+                with torch.autocast(device_type="cuda", dtype=AMP_DTYPE, enabled=DEVICE == "cuda"):
+                    output = model.lm.compute_predictions(
+                        codes.clamp_min(0), conditions, condition_tensors=condition_tensors
+                    )
                     
-                    conditions = model.lm.condition_provider(attributes)
-                    
-                    codes = model.compression_model.encode(wavs)
-                    
-                    logits = model.lm.compute_predictions(codes[0], conditions)
-                    
+                    # Steps the delay pattern leaves invalid (NaN logits) are ignored like padding.
+                    # The (B, K, T, card) logits come back permuted, so make them contiguous once
+                    # and flatten as a view rather than letting reshape copy.
+                    logits = output.logits.contiguous()
+                    targets = codes.masked_fill(~output.mask, PAD_CODE)
                     loss = torch.nn.functional.cross_entropy(
-                        logits.reshape(-1, logits.size(-1)),
-                        codes[0].reshape(-1)
+                        logits.flatten(0, -2),
+                        targets.flatten(),
+                        ignore_index=PAD_CODE,
+                        reduction='mean',
+                        label_smoothing=0.0
                     )
                     
                     loss = loss / GRADIENT_ACCUMULATION_STEPS
                 
-                loss.backward()
+                scaler.scale(loss).backward()
                 
                 if (batch_idx + 1) % GRADIENT_ACCUMULATION_STEPS == 0:
+                    scaler.unscale_(optimizer)
                     torch.nn.utils.clip_grad_norm_(model.lm.parameters(), max_norm=1.0)
                     
-                    optimizer.step()
+                    scaler.step(optimizer)
+                    scaler.update()
                     scheduler.step()
-                    optimizer.zero_grad()
+                    optimizer.zero_grad(set_to_none=True)
                     
                     global_step += 1
                 
@@ -262,6 +675,7 @@ def train_musicgen():
                     logger.info(
                         f"Epoch {epoch+1}/{NUM_EPOCHS} | "
                         f"Batch {batch_idx}/{len(dataloader)} | "
+                        f"Step {global_step} | "
                         f"Loss: {loss.item():.4f} | "
                         f"LR: {current_lr:.2e}"
                     )
@@ -284,24 +698,29 @@ def train_musicgen():
         avg_epoch_loss = epoch_loss / len(dataloader)
         logger.info(f"\nEpoch {epoch+1} completed - Avg Loss: {avg_epoch_loss:.4f}")
         
+        # One CPU snapshot per epoch, shared by every checkpoint written below
+        model_state = _cpu_snapshot(model.lm.state_dict())
+        optimizer_state = _cpu_snapshot(optimizer.state_dict())
+        
         # Save last.ckpt EVERY epoch for Spot instance resilience
-        torch.save({
+        checkpoint_writer.submit({
             'epoch': epoch,
             'global_step': global_step,
-            'model_state_dict': model.lm.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
+            'model_state_dict': model_state,
+            'optimizer_state_dict': optimizer_state,
             'scheduler_state_dict': scheduler.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
             'loss': avg_epoch_loss,
             'best_loss': best_loss,
         }, LAST_CHECKPOINT)
-        logger.info(f"💾 Saved last.ckpt (Spot resume enabled)")
+        logger.info(f"💾 Saving last.ckpt (Spot resume enabled)")
         
         # Save best model if loss improved
         if avg_epoch_loss < best_loss:
             best_loss = avg_epoch_loss
-            torch.save({
+            checkpoint_writer.submit({
                 'epoch': epoch,
-                'model_state_dict': model.lm.state_dict(),
+                'model_state_dict': model_state,
                 'loss': best_loss,
             }, BEST_CHECKPOINT)
             logger.info(f"⭐ New best model! Loss: {best_loss:.4f}")
@@ -310,15 +729,15 @@ def train_musicgen():
         if (epoch + 1) % SAVE_EVERY_N_EPOCHS == 0:
             checkpoint_path = CHECKPOINT_DIR / f"musicgen_amapiano_epoch_{epoch+1}.pt"
             
-            torch.save({
+            checkpoint_writer.submit({
                 'epoch': epoch,
-                'model_state_dict': model.lm.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
+                'model_state_dict': model_state,
+                'optimizer_state_dict': optimizer_state,
                 'scheduler_state_dict': scheduler.state_dict(),
                 'loss': avg_epoch_loss,
             }, checkpoint_path)
             
-            logger.info(f"📦 Saved periodic checkpoint: {checkpoint_path}")
+            logger.info(f"📦 Saving periodic checkpoint: {checkpoint_path}")
         
         metrics.save()
     
@@ -327,8 +746,8 @@ def train_musicgen():
     logger.info("="*60)
     
     final_model_path = CHECKPOINT_DIR / "musicgen_amapiano_final.pt"
-    torch.save({
-        'model_state_dict': model.lm.state_dict(),
+    checkpoint_writer.submit({
+        'model_state_dict': _cpu_snapshot(model.lm.state_dict()),
         'training_config': {
             'epochs': NUM_EPOCHS,
             'batch_size': BATCH_SIZE,
@@ -336,6 +755,8 @@ def train_musicgen():
             'dataset_clips': len(dataset),
         }
     }, final_model_path)
+    checkpoint_writer.close()
+    metrics.close()
     
     logger.info(f"\nFinal model saved to: {final_model_path}")
     logger.info(f"Training logs: {LOGS_DIR}")
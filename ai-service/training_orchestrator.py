@@ -9,11 +9,20 @@ import pandas as pd
 from pathlib import Path
 import logging
 import json
+import re
 import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple
 import subprocess
 import sys
+import os
+import threading
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,6 +30,39 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Mirrors the progress line train_musicgen.py logs every 10 batches
+_METRIC_RE = re.compile(r"Epoch (\d+)/\d+ \| Batch \d+/\d+ \| Step (\d+) \| Loss: ([\d.]+) \| LR: ([\d.e+-]+)")
+_VAL_LOSS_RE = re.compile(r"Val Loss: ([\d.]+)")
+
+MILESTONE_CHECK_INTERVAL_S = 60
+TRAINER_STOP_TIMEOUT_S = 30  # grace period after SIGTERM before the trainer is killed
+
+
+def _dumps(obj) -> bytes:
+    """Indented JSON as bytes; orjson when installed, which also serializes numpy values"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, indent=2).encode()
+
+
+def _tail_f(path: Path, stop: threading.Event, poll_s: float = 0.1):
+    """Yield complete lines appended to path until stop is set and the file is drained"""
+    with open(path, 'r', errors='replace') as f:
+        pending = ''
+        while True:
+            chunk = f.readline()
+            if chunk:
+                pending += chunk
+                if pending.endswith('\n'):
+                    yield pending
+                    pending = ''
+            elif stop.is_set():
+                if pending:
+                    yield pending
+                return
+            else:
+                time.sleep(poll_s)
+
 
 class TrainingOrchestrator:
     """
@@ -49,6 +91,8 @@ class TrainingOrchestrator:
         self.global_step = 0
         self.best_val_loss = float('inf')
         self.week_5_metrics = None
+        self.process = None
+        self._tail_error = None
         
     def load_config(self, config_path: Path = None) -> Dict:
         """Load training configuration"""
@@ -57,10 +101,12 @@ class TrainingOrchestrator:
             'dataset_dir': './datasets/amapiano_proxy',
             'checkpoint_dir': './checkpoints/phase_2_5',
             'tensorboard_dir': './runs/phase_2_5',
-            'batch_size': 8,
+            'trainer_log': './training_logs/trainer.log',
+            'batch_size': 16,
             'learning_rate': 1e-5,
             'num_epochs': 20,
-            'gradient_accumulation_steps': 4,
+            'gradient_accumulation_steps': 2,
+            'use_grad_checkpointing': True,  # frees the activation memory for batch_size 16
             'warmup_steps': 500,
             'save_every_n_steps': 1000,
             'eval_every_n_steps': 500,
@@ -104,6 +150,8 @@ class TrainingOrchestrator:
         
         logger.info("Starting training monitoring...")
         
+        stop_tailing = threading.Event()
+        tailer = None
         try:
             # Launch training script
             training_script = Path(__file__).parent / 'train_musicgen.py'
@@ -120,26 +168,41 @@ class TrainingOrchestrator:
             
             logger.info(f"Launching: {' '.join(cmd)}")
             
-            # Run with real-time output
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1
-            )
+            # The trainer writes to a log file rather than a pipe, so it never blocks on
+            # the orchestrator reading it. Its own session keeps a terminal Ctrl-C from
+            # reaching it directly; stop_trainer() shuts it down on every exit path.
+            trainer_log = Path(self.config['trainer_log'])
+            trainer_log.parent.mkdir(exist_ok=True, parents=True)
+            with open(trainer_log, 'w') as log_file:
+                self.process = subprocess.Popen(
+                    cmd,
+                    stdout=log_file,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                    env={
+                        **os.environ,
+                        'AMAPIANO_GRAD_CHECKPOINTING': '1' if self.config['use_grad_checkpointing'] else '0',
+                        'PYTHONUNBUFFERED': '1',
+                    }
+                )
+            process = self.process
+            logger.info(f"Trainer PID {process.pid}, logging to {trainer_log}")
             
-            # Monitor training progress
-            for line in process.stdout:
-                print(line, end='')
-                
-                # Parse metrics from output
-                self.parse_training_metrics(line)
-                
-                # Check for Week 5 checkpoint
-                self.check_week_5_milestone()
+            # Parse metrics from the log on a background thread
+            tailer = threading.Thread(
+                target=self._follow_trainer_log, args=(trainer_log, stop_tailing), daemon=True
+            )
+            tailer.start()
             
-            process.wait()
+            # Check for Week 5 checkpoint while the trainer runs
+            while True:
+                try:
+                    process.wait(timeout=MILESTONE_CHECK_INTERVAL_S)
+                    break
+                except subprocess.TimeoutExpired:
+                    if not tailer.is_alive():
+                        raise RuntimeError("Trainer log follower stopped") from self._tail_error
+                    self.check_week_5_milestone()
             
             if process.returncode != 0:
                 logger.error(f"Training failed with code {process.returncode}")
@@ -147,35 +210,64 @@ class TrainingOrchestrator:
                 logger.info("Training completed successfully!")
                 
         except KeyboardInterrupt:
-            logger.warning("Training interrupted by user")
+            logger.warning("Orchestrator interrupted by user")
             self.save_checkpoint(interrupted=True)
         except Exception as e:
             logger.error(f"Training error: {e}", exc_info=True)
             self.save_checkpoint(interrupted=True)
+        finally:
+            # The trainer has its own session, so nothing else will stop it if we leave
+            self.stop_trainer()
+            stop_tailing.set()
+            if tailer is not None:
+                tailer.join()
+    
+    def stop_trainer(self):
+        """Terminate the trainer if it is still running, killing it if SIGTERM is ignored"""
+        if self.process is None or self.process.poll() is not None:
+            return
+        logger.warning(f"Stopping trainer (PID {self.process.pid})")
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=TRAINER_STOP_TIMEOUT_S)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Trainer did not exit after {TRAINER_STOP_TIMEOUT_S}s - killing it")
+            self.process.kill()
+            self.process.wait()
+    
+    def _follow_trainer_log(self, trainer_log: Path, stop: threading.Event):
+        """Echo and parse trainer output as it is appended to the log file"""
+        try:
+            for line in _tail_f(trainer_log, stop):
+                print(line, end='')
+                self.parse_training_metrics(line)
+        except Exception as e:
+            logger.error(f"Trainer log follower failed: {e}", exc_info=True)
+            self._tail_error = e
     
     def parse_training_metrics(self, log_line: str):
         """Parse metrics from training log output"""
-        # Example: "Epoch 5/20 | Step 1500 | Loss: 2.345 | Val Loss: 2.567"
+        # Example: "Epoch 5/20 | Batch 150/400 | Step 1075 | Loss: 2.3450 | LR: 9.87e-06"
         
-        try:
-            if 'Step' in log_line and 'Loss' in log_line:
-                parts = log_line.split('|')
-                
-                for part in parts:
-                    if 'Epoch' in part:
-                        self.current_epoch = int(part.split()[1].split('/')[0])
-                    elif 'Step' in part:
-                        self.global_step = int(part.split()[1])
-                    elif 'Val Loss' in part:
-                        val_loss = float(part.split(':')[1].strip())
-                        self.writer.add_scalar('Loss/validation', val_loss, self.global_step)
-                        
-                        if val_loss < self.best_val_loss:
-                            self.best_val_loss = val_loss
-                            logger.info(f"New best validation loss: {val_loss:.4f}")
-        
-        except Exception as e:
-            pass  # Ignore parsing errors
+        m = _METRIC_RE.search(log_line)
+        if m:
+            loss, lr = float(m[3]), float(m[4])
+            
+            self.current_epoch = int(m[1])
+            # Optimizer steps as counted by the trainer (one per gradient accumulation cycle)
+            self.global_step = int(m[2])
+            self.writer.add_scalar('Loss/train', loss, self.global_step)
+            self.writer.add_scalar('LR', lr, self.global_step)
+            return
+        
+        m = _VAL_LOSS_RE.search(log_line)
+        if m:
+            val_loss = float(m[1])
+            self.writer.add_scalar('Loss/validation', val_loss, self.global_step)
+            
+            if val_loss < self.best_val_loss:
+                self.best_val_loss = val_loss
+                logger.info(f"New best validation loss: {val_loss:.4f}")
     
     def check_week_5_milestone(self):
         """Evaluate Week 5 Go/No-Go decision point"""
@@ -235,8 +327,8 @@ class TrainingOrchestrator:
         
         # Save metrics
         metrics_path = self.checkpoint_dir / 'week_5_metrics.json'
-        with open(metrics_path, 'w') as f:
-            json.dump(metrics, f, indent=2)
+        with open(metrics_path, 'wb') as f:
+            f.write(_dumps(metrics))
         
         return metrics
     
@@ -304,8 +396,11 @@ class TrainingOrchestrator:
         }
         
         report_path = self.checkpoint_dir / 'abort_report.json'
-        with open(report_path, 'w') as f:
-            json.dump(abort_report, f, indent=2)
+        with open(report_path, 'wb') as f:
+            f.write(_dumps(abort_report))
+        
+        # The trainer runs in its own session, so it has to be stopped explicitly
+        self.stop_trainer()
         
         logger.warning(f"Abort report saved: {report_path}")
         logger.warning("Next steps:")
@@ -328,8 +423,8 @@ class TrainingOrchestrator:
         }
         
         checkpoint_path = self.checkpoint_dir / 'orchestrator_state.json'
-        with open(checkpoint_path, 'w') as f:
-            json.dump(checkpoint, f, indent=2)
+        with open(checkpoint_path, 'wb') as f:
+            f.write(_dumps(checkpoint))
         
         logger.info(f"Checkpoint saved: {checkpoint_path}")
 